@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Memory and speed of the image listings kept in memory: the JSON dicts of describe-images and the list of digest
+# strings of the old purge ('untagged_images.rstrip().split('\n')') against the columns of ImageInventory.
+#
+#   python3 bench_inventory.py [images] > bench_output.txt
+
+import hashlib
+import random
+import sys
+import time
+import tracemalloc
+
+from init import ImageInventory
+
+REPOS = 2000
+TAGS_PER_IMAGE = 0.6
+
+
+def make_details(count):
+    rng = random.Random(42)
+    details = []
+    for i in range(count):
+        image = {'registryId': '350801433917', 'repositoryName': 'products/org/product-%d-snapshot' % (i % REPOS),
+                 'imageDigest': 'sha256:' + hashlib.sha256(str(i).encode()).hexdigest(),
+                 'imageSizeInBytes': rng.randint(10 ** 6, 10 ** 9),
+                 'imagePushedAt': 1600000000 + rng.randint(0, 10 ** 8)}
+        if rng.random() < TAGS_PER_IMAGE:
+            image['imageTags'] = ['1.%d.%d' % (i % 50, i % 7)]
+        details.append(image)
+    return details
+
+
+# Build a representation twice: once timed, once traced (tracemalloc slows the allocations down)
+def measure(build):
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    details = make_details(count)
+    text = '\n'.join(image['imageDigest'] for image in details) + '\n'
+
+    dicts, dicts_size, dicts_time = measure(lambda: [dict(image, imageTags=list(image.get('imageTags', [])))
+                                                     for image in details])
+    strings, strings_size, strings_time = measure(lambda: text.rstrip().split('\n'))
+    inventory, inventory_size, inventory_time = measure(lambda: build_inventory(details))
+
+    print('%d images in %d repositories' % (count, REPOS))
+    print()
+    print('%-40s %12s %10s %10s' % ('REPRESENTATION', 'MEMORY', 'BYTES/IMG', 'BUILD'))
+    for name, size, elapsed in (('describe-images dicts', dicts_size, dicts_time),
+                                ('list of digest strings (digests only)', strings_size, strings_time),
+                                ('ImageInventory', inventory_size, inventory_time)):
+        print('%-40s %9.1f MB %10.0f %9.2fs' % (name, size / 1e6, size / count, elapsed))
+    print()
+
+    # untagged minus protected (the digests with a '1.0.' tag) and the untagged images sorted by age
+    _, dicts_difference = timed(lambda: dicts_untagged_minus_protected(dicts))
+    _, inventory_difference = timed(lambda: inventory.difference(inventory.untagged(),
+                                                                 inventory.with_tags_matching(r'^1\.0\.')))
+    _, dicts_sort = timed(lambda: sorted((image for image in dicts if not image['imageTags']),
+                                         key=lambda image: image['imagePushedAt']))
+    _, inventory_sort = timed(lambda: inventory.sorted_by_age(inventory.untagged()))
+    print('%-40s %10s %10s' % ('OPERATION', 'DICTS', 'INVENTORY'))
+    print('%-40s %9.3fs %9.3fs' % ('untagged minus protected', dicts_difference, inventory_difference))
+    print('%-40s %9.3fs %9.3fs' % ('untagged sorted by age', dicts_sort, inventory_sort))
+
+
+def build_inventory(details):
+    inventory = ImageInventory()
+    inventory.add_details(details)
+    return inventory
+
+
+def dicts_untagged_minus_protected(dicts):
+    protected = set(image['imageDigest'] for image in dicts
+                    if any(tag.startswith('1.0.') for tag in image['imageTags']))
+    return [image for image in dicts if not image['imageTags'] and image['imageDigest'] not in protected]
+
+
+if __name__ == '__main__':
+    main()
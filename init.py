@@ -11,6 +11,7 @@ import sys
 from argparse import ArgumentParser, ArgumentError, RawDescriptionHelpFormatter
 import subprocess
 import json
+import time
 
 
 ### UTILITIES FUNCTIONS
@@ -34,6 +35,22 @@ def usr_inp(stdout_msg):
     return rsp.strip()
 
 
+# Format a number of bytes with a binary unit (e.g. '1.5 GiB')
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if abs(size) < 1024 or unit == 'TiB':
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+
+
+# Major and minor of a version string (e.g. '4.14.0' -> (4, 14)), an empty tuple (lower than any version) when
+# it can't be parsed
+def parse_major_minor(version):
+    import re
+    match = re.match(r'v?(\d+)\.(\d+)', str(version).strip())
+    return (int(match.group(1)), int(match.group(2))) if match else ()
+
+
 def printflush(text, stream=sys.stdout):
     msg = ''
     stream.write(msg)
@@ -75,6 +92,25 @@ def runcmd_call(cmd):
 
 # END
 
+# Max number of image ids accepted by a single ECR BatchDeleteImage call
+ECR_BATCH_DELETE_MAX = 100
+
+# Default size of the worker pool used by the commands that work on many repositories at once
+DEFAULT_WORKERS = 4
+
+# Defaults of the lifecycle policy of the snapshot repositories
+DEFAULT_UNTAGGED_DAYS = 7
+DEFAULT_KEEP_TAGGED = 100
+
+# Severities of the scan findings, the most severe first
+SCAN_SEVERITIES = ('CRITICAL', 'HIGH', 'MEDIUM', 'LOW', 'INFORMATIONAL', 'UNDEFINED')
+
+# Defaults of prune-stale: snapshot images neither pulled nor pushed in this many days are stale, but the most
+# recent ones of every repository are always kept
+DEFAULT_STALE_DAYS = 90
+DEFAULT_KEEP_LAST = 10
+
+
 def parse_args():
     # formatter class
     import textwrap
@@ -87,21 +123,58 @@ def parse_args():
 
     ### AWS SECTION
 
-    # Login and logout docker repository on AWS ECR (the released token is 12 hours valid):
+    # Login and logout docker repository on AWS ECR (the released token is 12 hours valid and it is cached,
+    # so the login is skipped while the runtime holds a valid token):
      -------------------------------------------------------------------------------
         ./${script.py} --aws {login|logout} --containerruntime {docker|podman}
 
+    # Use this script as credential helper of the container runtime for AWS ECR: pull and push get the cached
+    # token without any login
+     -------------------------------------------------------------------------------
+        ./${script.py} --aws credential-helper --containerruntime {docker|podman}
+
     # Remove all the untagged images from a specific AWS ECR repository:
      -------------------------------------------------------------------------------
         ./${script.py} --aws purge-images
 
-    # Remove all the untagged images from AWS ECR repository:
+    # Remove all the untagged images from AWS ECR repository (N repositories processed concurrently). Every run
+    # is journaled: an interrupted run can be resumed and the deleted digests can be audited afterwards:
     -------------------------------------------------------------------------------
-        ./${script.py} --aws purge-images-all
+        ./${script.py} --aws purge-images-all [--workers N] [--resume]
+        ./${script.py} --aws purge-audit [--limit N]
 
-    # List all the images from an AWS ECR repository:
+    # Remove the tagged and untagged snapshot images nobody has pulled in the last N days, keeping the most recent
+    # ones of every repository and the protected tags (--dry-run only prints the images and bytes to delete):
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws prune-stale [--stale-days N] [--keep-last N] [--protect-tags REGEX] [--dry-run]
+
+    # Refresh the local inventory of the ECR repositories and images (only the changed repositories are
+    # described again) and query it without calling ECR:
+     -------------------------------------------------------------------------------
+        ./${script.py} --aws inventory-refresh [--inventory-ttl SECONDS]
+        ./${script.py} --aws inventory-query --query {untagged-snapshot|largest-repos} [--limit N]
+        ./${script.py} --aws {purge-images|purge-images-all} --from-inventory [--inventory-ttl SECONDS]
+
+    # Report the storage used by every repository, the largest images and the bytes reclaimed by each purge
+    # strategy (the lifecycle one as configured by --untagged-days and --keep-tagged, prune-stale as configured
+    # by --stale-days, --keep-last and --protect-tags):
+     -------------------------------------------------------------------------------
+        ./${script.py} --aws storage-report [--limit N] [--workers N] [--stale-days N] [--keep-last N]
+
+    # Summarize by severity the scan findings of the latest N images of every repository (the completed scans
+    # are cached by digest, so only the new images are queried):
+     -------------------------------------------------------------------------------
+        ./${script.py} --aws scan-report [--limit N] [--workers N]
+
+    # Find the digests stored in more than one repository (e.g. a snapshot promoted as-is to release) and the storage
+    # they account for, from ECR or, in a few seconds, from the local inventory:
      -------------------------------------------------------------------------------
-        ./${script.py} --aws list-images
+        ./${script.py} --aws duplicates [--limit N] [--from-inventory]
+
+    # List all the images from an AWS ECR repository, streamed page by page (any field other than imageDigest and
+    # imageTag comes from describe-images):
+     -------------------------------------------------------------------------------
+        ./${script.py} --aws list-images [--format {json|ndjson|table}] [--fields imageDigest,imageTags,imageSizeInBytes]
 
     # Configure a profile under the files /.aws/config and /.aws/credentials
     -------------------------------------------------------------------------------
@@ -115,18 +188,48 @@ def parse_args():
     -------------------------------------------------------------------------------
         ./${script.py} --aws get-current-profile
 
-    # Create repo on ECR for both release and snapshot
+    # Create repo on ECR for both release and snapshot (the snapshot one gets the lifecycle policy)
     -------------------------------------------------------------------------------
         ./${script.py} --aws create-repo
 
+    # Generate the lifecycle policy of the snapshot repositories, compare it with the one of every snapshot
+    # repository or apply it where it is missing or different (ECR then expires the images by itself):
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws {lifecycle-generate|lifecycle-diff|lifecycle-apply} [--untagged-days N] [--keep-tagged N]
+
     # Delete repo on ECR
     -------------------------------------------------------------------------------
         ./${script.py} --aws delete-repo
 
+    # Promote tags from the snapshot repo to the release one on the registry side (no pull/push of the layers);
+    # the release digests are verified afterwards:
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws promote [--workers N]
+
+    # Create or delete all the repositories of a manifest (JSON, or YAML with PyYAML): only the missing ones are
+    # created and only the existing ones are deleted, concurrently:
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws {create-repo|delete-repo} --manifest repositories.json [--workers N]
+
     # Get AWS cli version
     -------------------------------------------------------------------------------
         ./${script.py} --aws version
 
+    # Run a command on many accounts and regions at once (fleet mode): one process per target, the outputs are
+    # printed target by target followed by a summary report:
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws {login|list-images|create-repo|purge-images-all} --targets dev:eu-west-1:REGISTRY,prod:us-east-1:REGISTRY
+        ./${script.py} --aws purge-images-all --targets @targets.txt
+
+    # Choose how the ECR API is called (in-process HTTPS client or AWS cli) and override its endpoint:
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws {...} --ecr-backend {auto|http|cli} [--endpoint-url URL]
+
+    # The ECR calls are rate limited per API and the throttled ones are retried with backoff: print the observed
+    # request rate and retries, to tune --workers:
+    -------------------------------------------------------------------------------
+        ./${script.py} --aws {...} --ecr-stats
+
     ### DOCKER SECTION
 
     # Get Docker information
@@ -146,6 +249,32 @@ def parse_args():
         ./${script.py} --docker {tag}
 
 
+    ### BULK IMAGES SECTION
+
+    # Pull, tag or push a list of images with the container runtime, N at a time (images from --images or from a
+    # JSON/YAML --manifest of {"image", "target"} items):
+    -------------------------------------------------------------------------------
+        ./${script.py} --bulk {pull|push} --containerruntime {docker|podman} --images IMAGE1,IMAGE2 [--workers N]
+        ./${script.py} --bulk tag --images SOURCE1=TARGET1,SOURCE2=TARGET2
+        ./${script.py} --bulk push --images @images.txt
+
+    # Before a push (--bulk, --docker or --podman) the tags of the ECR images are compared with the local digests
+    # (profile in AWS_PROFILE): the images already present are skipped, as the ones whose tag is taken in an
+    # IMMUTABLE repository
+    -------------------------------------------------------------------------------
+        ./${script.py} --bulk push --images @images.txt [--force-push]
+        ./${script.py} --docker push [--force-push]
+
+    # Pull, tag and push (also --docker and --podman ones) go through the REST API of the runtime socket when it
+    # answers, with the progress streamed, and through the cli otherwise:
+    -------------------------------------------------------------------------------
+        ./${script.py} --bulk pull --images @images.txt --runtime-api {auto|socket|cli} [--runtime-socket PATH]
+
+    # Per-layer bytes, time and throughput, time to first byte and wall time of the pulls and pushes, measured on
+    # the progress stream of the runtime socket, as JSON and as a Prometheus textfile:
+    -------------------------------------------------------------------------------
+        ./${script.py} --bulk push --images @images.txt --transfer-stats push.json [--prometheus-textfile push.prom]
+
     ### PODMAN SECTION
 
     # Get Podman information
@@ -196,7 +325,80 @@ def parse_args():
     #    parser.add_argument('action', help='Choice the action', nargs='?', choices=['build', 'up', 'pull'])
     parser.add_argument('--aws', help='AWS ECR functions', nargs=1,
                         choices=['login', 'logout', 'purge-images', 'purge-images-all', 'list-images', 'set-profile',
-                                 'get-profile', 'get-current-profile', 'version', 'create-repo', 'delete-repo'])
+                                 'get-profile', 'get-current-profile', 'version', 'create-repo', 'delete-repo',
+                                 'credential-helper', 'inventory-refresh', 'inventory-query', 'lifecycle-generate',
+                                 'lifecycle-diff', 'lifecycle-apply', 'purge-audit', 'storage-report',
+                                 'prune-stale', 'scan-report', 'duplicates', 'promote'])
+    parser.add_argument('-w', '--workers', help='Number of concurrent workers: repositories of purge-images-all, '
+                                                'inventory-refresh, lifecycle-*, storage-report, scan-report, '
+                                                'duplicates, prune-stale and --manifest, tags of promote, images of '
+                                                '--bulk, targets of --targets', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--ecr-backend', help='How to call the ECR API: in-process over pooled HTTPS connections '
+                                              '(http), by spawning the AWS cli (cli) or http when the profile has '
+                                              'static credentials and cli otherwise (auto)',
+                        choices=['auto', 'http', 'cli'], default='auto')
+    parser.add_argument('--endpoint-url', help='Override the ECR API endpoint (e.g. a local fake ECR server)')
+    parser.add_argument('--credential-helper', help='Serve the docker credential helper protocol (used by the '
+                                                    'runtime through the launcher written by --aws credential-helper)',
+                        choices=['get', 'store', 'erase', 'list'])
+    parser.add_argument('--format', help='Output format of list-images and inventory-query, streamed record by '
+                                         'record', choices=['json', 'ndjson', 'table'], dest='output_format')
+    parser.add_argument('--fields', help='Comma separated fields of the records written by list-images and '
+                                         'inventory-query (e.g. imageDigest,imageTags,imageSizeInBytes)',
+                        type=lambda value: [field.strip() for field in value.split(',') if field.strip()])
+    parser.add_argument('--manifest', help='JSON or YAML manifest: the repositories of create-repo and delete-repo, '
+                                           'or the images of --bulk')
+    parser.add_argument('--registry', help='ECR registry used by login, logout and credential-helper (promote '
+                                           'mounts blobs on the registry of the repository unless it is given)',
+                        default=DEFAULT_ECR_REGISTRY)
+    parser.add_argument('--targets', help='Run login, list-images, create-repo or purge-images-all on many '
+                                          'registries at once: comma separated PROFILE[:REGION[:REGISTRY]] '
+                                          'targets, or @FILE with one target per line')
+    parser.add_argument('--ecr-stats', help='Print the request rate, throttling and retries of every ECR API used '
+                                            'by the command', action='store_true')
+    parser.add_argument('--no-cache', help='Probe the version of aws, oc, docker, podman and s2i again instead of '
+                                           'using the cached one', action='store_true')
+    parser.add_argument('--from-inventory', help='Take the untagged images to purge from the local inventory instead '
+                                                 'of listing them on ECR', action='store_true')
+    parser.add_argument('--inventory-ttl', help='Seconds during which a repository of the inventory is not listed '
+                                                'again by inventory-refresh, and max age of the inventory of the '
+                                                'repositories purged with --from-inventory (1 hour when 0)',
+                        type=int, default=0)
+    parser.add_argument('--query', help='Query answered by inventory-query from the local inventory',
+                        choices=['untagged-snapshot', 'largest-repos'], default='untagged-snapshot')
+    parser.add_argument('--limit', help='Max number of rows printed by the reports', type=int, default=0)
+    parser.add_argument('--resume', help='Resume the last interrupted purge-images-all run from its journal',
+                        action='store_true')
+    parser.add_argument('--stale-days', help='prune-stale: days without pulls (or pushes) after which a snapshot '
+                                             'image is stale', type=int, default=DEFAULT_STALE_DAYS)
+    parser.add_argument('--keep-last', help='prune-stale: number of most recent images always kept in every '
+                                            'snapshot repository', type=int, default=DEFAULT_KEEP_LAST)
+    parser.add_argument('--protect-tags', help='prune-stale: regular expression of the tags that are never pruned')
+    parser.add_argument('--dry-run', help='prune-stale: print the plan without deleting anything',
+                        action='store_true')
+    parser.add_argument('--untagged-days', help='Lifecycle policy: days after which the untagged snapshot images '
+                                                'expire (0 to disable the rule)', type=int,
+                        default=DEFAULT_UNTAGGED_DAYS)
+    parser.add_argument('--keep-tagged', help='Lifecycle policy: number of tagged images kept in each snapshot '
+                                              'repository (0 to disable the rule)', type=int,
+                        default=DEFAULT_KEEP_TAGGED)
+    parser.add_argument('--bulk', help='Pull, tag or push many images at once with the --containerruntime, '
+                                       '--workers of them at a time', choices=['pull', 'tag', 'push'])
+    parser.add_argument('--images', help='Images of --bulk: comma separated IMAGE (SOURCE=TARGET for tag), or '
+                                         '@FILE with one image per line')
+    parser.add_argument('--force-push', help='--bulk, --docker and --podman push: push also the ECR images whose tag '
+                                             'already has the local digest', action='store_true')
+    parser.add_argument('--runtime-api', help='How pull, tag and push talk to docker or podman: over the REST API '
+                                              'of their unix socket (socket), by spawning the cli (cli) or socket '
+                                              'when it answers and cli otherwise (auto)',
+                        choices=['auto', 'socket', 'cli'], default='auto')
+    parser.add_argument('--runtime-socket', help='Unix socket of the docker or podman API (default: DOCKER_HOST or '
+                                                 'CONTAINER_HOST, then the default socket of the service)')
+    parser.add_argument('--transfer-stats', help='Write the per-layer bytes, time and throughput, the time to first '
+                                                 'byte and the wall time of every pull and push to this JSON file')
+    parser.add_argument('--prometheus-textfile', help='Write the same transfer metrics to this file in the '
+                                                      'Prometheus text format (for the textfile collector of the '
+                                                      'node exporter)')
     parser.add_argument('--docker', help='Docker functions', nargs=1,
                         choices=['version', 'pull', 'push', 'tag'])
     parser.add_argument('--podman', help='Podman functions', nargs=1,
@@ -223,46 +425,588 @@ def parse_args():
         ./${script.py} --help ''')
 
 
-# Class to manage Docker
-class Docker:
+### CONTAINER RUNTIME API
+# START
 
-    def __init__(self):
-        pass
+# Version of the Docker Engine API called on the runtime socket: served by Docker 19.03+ and by the Docker
+# compatible API of the Podman service
+RUNTIME_API_VERSION = 'v1.40'
+
+# Seconds without any data after which a request to the runtime socket fails. Pulls and pushes stream their
+# progress, so only a stuck transfer hits it.
+RUNTIME_API_TIMEOUT = 300
+
+
+# Error returned by the API of the container runtime. The status is the HTTP status of the response, None for
+# an error reported in the middle of a progress stream; progress holds the messages streamed before the error.
+class RuntimeApiError(Exception):
+
+    def __init__(self, status, message='', progress=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.progress = progress or []
+
+    def __str__(self):
+        return str(self.status) + ': ' + self.message
+
+
+# Unix socket of the API of the runtime: the unix:// URL of DOCKER_HOST (CONTAINER_HOST for podman) or the
+# default socket of the service. None when there's no socket, or the host is remote (left to the cli).
+def runtime_socket_path(container_runtime):
+    import os
+    host = os.environ.get('CONTAINER_HOST' if container_runtime == 'podman' else 'DOCKER_HOST', '')
+    if host:
+        return host[len('unix://'):] if host.startswith('unix://') else None
+    if container_runtime == 'podman':
+        candidates = ['/run/podman/podman.sock']
+        if os.environ.get('XDG_RUNTIME_DIR'):
+            candidates.insert(0, os.path.join(os.environ['XDG_RUNTIME_DIR'], 'podman', 'podman.sock'))
+    else:
+        candidates = ['/var/run/docker.sock']
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+# Split an image reference into the name and the tag (or digest) used by the API, e.g.
+# 'host:5000/repo:1.0' -> ('host:5000/repo', '1.0')
+def split_image_reference(image):
+    name, at, digest = image.partition('@')
+    if at:
+        return name, digest
+    slash, colon = name.rfind('/'), name.rfind(':')
+    if colon > slash:
+        return name[:colon], name[colon + 1:]
+    return name, 'latest'
+
+
+# Registry of an image name: its first component when it is a host name, Docker Hub otherwise
+def image_registry(name):
+    first, slash, _ = name.partition('/')
+    if slash and ('.' in first or ':' in first or first == 'localhost'):
+        return first
+    return 'docker.io'
+
+
+# Credential of the runtime for a registry, read the way the cli does: from the credential helper of the
+# registry (credHelpers), from the default store (credsStore) or from the auths of the auth file. Returns the
+# auth config of the Docker API ({'username', 'password', 'serveraddress'}) or None.
+def runtime_registry_auth(container_runtime, registry):
+    import base64
+    path = runtime_auth_file(container_runtime)
+    if path is None:
+        return None
+    try:
+        with open(path) as auth_file:
+            config = json.load(auth_file)
+    except (OSError, ValueError):
+        return None
+
+    names = [registry, 'https://' + registry]
+    if registry == 'docker.io':
+        names = ['https://index.docker.io/v1/', 'index.docker.io', 'docker.io']
+    helper = config.get('credHelpers', {}).get(registry) or config.get('credsStore')
+    if helper:
+        try:
+            p = subprocess.run(['docker-credential-' + helper, 'get'], input=names[0].encode(),
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+            credential = json.loads(p.stdout.decode()) if p.returncode == 0 else None
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            credential = None
+        if credential and credential.get('Secret'):
+            if credential.get('Username') == '<token>':
+                return {'identitytoken': credential['Secret'], 'serveraddress': registry}
+            return {'username': credential.get('Username', ''), 'password': credential['Secret'],
+                    'serveraddress': registry}
+    for name in names:
+        auth = config.get('auths', {}).get(name, {}).get('auth')
+        if auth:
+            username, _, password = base64.b64decode(auth).decode(errors='replace').partition(':')
+            return {'username': username, 'password': password, 'serveraddress': registry}
+    return None
+
+
+# Value of the X-Registry-Auth header of a pull or push: the base64url encoded auth config ('{}' when the
+# runtime has no credential for the registry, the registry may be public)
+def registry_auth_header(container_runtime, registry):
+    import base64
+    auth = runtime_registry_auth(container_runtime, registry) or {}
+    return base64.urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+
+# HTTP connection to a unix socket
+def unix_http_connection(path, timeout=RUNTIME_API_TIMEOUT):
+    import http.client
+    import socket
+
+    class UnixHTTPConnection(http.client.HTTPConnection):
+
+        def connect(self):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(path)
+
+    return UnixHTTPConnection('localhost', timeout=timeout)
+
+
+# Client of the Docker Engine API (also served by Podman) on the unix socket of the runtime. Like the ECR http
+# backend it keeps a pool of persistent connections, so the threads of a bulk action don't connect at every
+# request.
+class RuntimeApiClient:
+
+    def __init__(self, socket_path, pool_size=DEFAULT_WORKERS):
+        import queue
+        self.socket_path = socket_path
+        self.pool = queue.LifoQueue(maxsize=max(1, pool_size))
+
+    def _get_connection(self):
+        import queue
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return unix_http_connection(self.socket_path)
 
-    def get_version(self):
-        cmd = ['docker', '--version']
-        res = runcmd_call(cmd)
-        res = res.strip().decode().replace('Docker version ', '')
+    def _put_connection(self, conn):
+        import queue
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    # Send a request and return the connection and the response, whose body is still to be read
+    def open(self, method, path, params=None, headers=None):
+        import http.client
+        from urllib.parse import quote, urlencode
+        url = '/' + RUNTIME_API_VERSION + quote(path, safe='/:@')
+        if params:
+            url += '?' + urlencode(params)
+
+        # a pooled connection may have been closed by the service while idle: retry once on a fresh one
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                conn.request(method, url, headers=headers or {})
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if attempt == 1:
+                    raise RuntimeApiError(None, 'cannot connect to ' + self.socket_path + ': ' + str(e))
+
+    @staticmethod
+    def error(rsp, data):
+        try:
+            message = json.loads(data.decode()).get('message', '')
+        except (ValueError, AttributeError):
+            message = data.decode(errors='replace').strip()
+        return RuntimeApiError(rsp.status, message or rsp.reason)
+
+    # Call the API and return the decoded JSON response (the text of the non JSON ones, e.g. '_ping')
+    def request(self, method, path, params=None, headers=None):
+        import http.client
+        conn, rsp = self.open(method, path, params, headers)
+        try:
+            data = rsp.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise RuntimeApiError(None, str(e))
+        self._put_connection(conn)
+        if rsp.status >= 400:
+            raise self.error(rsp, data)
+        try:
+            return json.loads(data.decode()) if data else None
+        except ValueError:
+            return data.decode(errors='replace')
+
+    # Call an API answering with a stream of JSON messages (the progress of a pull or push) and return the
+    # messages. Each one is passed to callback as soon as it is received. An error message in the stream raises
+    # a RuntimeApiError, like an HTTP error.
+    def stream(self, method, path, params=None, headers=None, callback=None):
+        import http.client
+        conn, rsp = self.open(method, path, params, headers)
+        if rsp.status >= 400:
+            data = rsp.read()
+            self._put_connection(conn)
+            raise self.error(rsp, data)
+
+        messages = []
+        try:
+            for line in rsp:
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line.decode())
+                except ValueError:
+                    message = {'status': line.decode(errors='replace').strip()}
+                messages.append(message)
+                if callback:
+                    callback(message)
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise RuntimeApiError(None, str(e), messages)
+        self._put_connection(conn)
+
+        for message in messages:
+            if message.get('error') or message.get('errorDetail'):
+                detail = message.get('errorDetail') or {}
+                raise RuntimeApiError(detail.get('code'), message.get('error') or detail.get('message', ''),
+                                      messages)
+        return messages
+
+
+# Print a message of a pull or push progress stream like the cli does, without the progress bars
+def print_progress(message):
+    if message.get('progress') or message.get('error') or not message.get('status'):
+        return
+    print((message['id'] + ': ' if message.get('id') else '') + message['status'])
 
-        # version = float(res[0:8].strip()[:5])
-        #
-        # if version < 17.07:
-        #     sys.exit('WARN: The minimum Docker version supported to be able to use AWS-cli is 17.07. Update your '
-        #              'current version!')
-        return res
 
+# END
+
+
+### TRANSFER METRICS
+# START
+
+# Statuses of the progress stream of a pull or push: a layer is transferred with the progress ones and done at
+# the first done one (the exists ones skip the transfer of a layer already on the other side)
+TRANSFER_PROGRESS_STATUSES = ('Downloading', 'Pushing')
+TRANSFER_DONE_STATUSES = ('Download complete', 'Pushed')
+TRANSFER_EXISTS_STATUSES = ('Already exists', 'Layer already exists', 'Mounted from')
+
+# Prefix of the metrics written in the Prometheus textfile
+PROMETHEUS_PREFIX = 'ea_utilities_'
+
+
+# Per-layer metrics of a pull or push, measured on its progress stream: update is the progress callback of the
+# action and stamps every message with the time it has been received. A layer is timed from its first progress
+# message to its done one, so its throughput is the one of the transfer alone, without the waiting for the
+# other layers. The first progress message already counts the bytes sent before it, so the throughput is
+# computed on the bytes sent after it. The time to first byte is the time from the start of the action to the
+# first byte transferred.
+class TransferMeter:
+
+    def __init__(self, action, image, runtime=None):
+        self.action = action
+        self.image = image
+        self.runtime = runtime
+        self.started_at = time.time()
+        self.first_byte_at = None
+        self.layers = {}
+
+    def update(self, message):
+        now = time.time()
+        status = message.get('status') or ''
+        layer_id = message.get('id')
+        if not layer_id or message.get('aux') or status.startswith('Pulling from'):
+            return
+        layer = self.layers.setdefault(layer_id, {'id': layer_id, 'status': 'waiting', 'bytes': 0, 'start': None,
+                                                  'end': None, 'offset': 0})
+        if status in TRANSFER_PROGRESS_STATUSES:
+            detail = message.get('progressDetail') or {}
+            if layer['start'] is None:
+                layer['start'] = now
+                layer['offset'] = detail.get('current') or 0
+            layer['bytes'] = max(layer['bytes'], detail.get('total') or 0, detail.get('current') or 0)
+            layer['status'] = 'transferring'
+            if self.first_byte_at is None and detail.get('current'):
+                self.first_byte_at = now
+        elif status in TRANSFER_DONE_STATUSES and layer['end'] is None:
+            layer['end'] = now
+            layer['status'] = 'transferred'
+        elif status.startswith(TRANSFER_EXISTS_STATUSES):
+            layer['status'] = 'exists'
+
+    # Summary of the action, a JSON serializable dict: the time to first byte, wall time, bytes and throughput
+    # of the image, then the same of every layer (throughput None when a layer was too small to be timed)
+    def summary(self, ok, elapsed):
+        layers = []
+        for layer in self.layers.values():
+            duration = None
+            if layer['start'] is not None and layer['end'] is not None:
+                duration = layer['end'] - layer['start']
+            layers.append({'id': layer['id'], 'status': layer['status'], 'bytes': layer['bytes'],
+                           'duration': duration,
+                           'throughput': (layer['bytes'] - layer['offset']) / duration
+                           if duration and layer['bytes'] > layer['offset'] else None})
+
+        timed = [layer for layer in self.layers.values() if layer['start'] is not None and layer['end'] is not None]
+        window = max(layer['end'] for layer in timed) - min(layer['start'] for layer in timed) if timed else 0
+        timed_bytes = sum(layer['bytes'] - layer['offset'] for layer in timed)
+        return {'action': self.action, 'image': self.image, 'runtime': self.runtime, 'ok': ok,
+                'started_at': self.started_at, 'elapsed': elapsed,
+                'time_to_first_byte': self.first_byte_at - self.started_at if self.first_byte_at else None,
+                'bytes': sum(layer['bytes'] for layer in self.layers.values() if layer['status'] == 'transferred'),
+                'throughput': timed_bytes / window if window and timed_bytes > 0 else None,
+                'layers': layers}
+
+
+# Print the layers of a transfer summary, the slowest first, and its totals
+def print_transfer_report(summary, stream=sys.stdout):
+    def rate(value):
+        return '-' if value is None else format_bytes(value) + '/s'
+
+    layers = sorted(summary['layers'], key=lambda layer: -(layer['duration'] or 0))
+    if not layers:
+        return
+    stream.write('%-20s %-12s %12s %10s %14s\n' % ('LAYER', 'STATUS', 'SIZE', 'TIME', 'THROUGHPUT'))
+    for layer in layers:
+        stream.write('%-20s %-12s %12s %10s %14s\n' % (
+            layer['id'][:20], layer['status'], format_bytes(layer['bytes']) if layer['bytes'] else '-',
+            '-' if layer['duration'] is None else '%.2fs' % layer['duration'], rate(layer['throughput'])))
+    stream.write('INFO: %s %s in %.2fs, %s, first byte after %s\n' % (
+        format_bytes(summary['bytes']), 'pulled' if summary['action'] == 'pull' else 'pushed', summary['elapsed'],
+        rate(summary['throughput']),
+        '-' if summary['time_to_first_byte'] is None else '%.2fs' % summary['time_to_first_byte']))
+
+
+# Write a text file atomically, so that a reader (e.g. the node exporter) never sees it half written
+def write_file_atomically(path, text):
+    import os
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+# Write the transfer summaries as a JSON document {"transfers": [summaries]}
+def write_transfer_stats(summaries, path):
+    import io
+    buffer = io.StringIO()
+    writer = RecordWriter('json', key='transfers', stream=buffer)
+    for summary in summaries:
+        writer.write(summary)
+    writer.close()
+    write_file_atomically(path, buffer.getvalue())
+
+
+# Write the transfer summaries in the Prometheus text format, for the textfile collector of the node exporter:
+# gauges of the last pull or push of every image and of its layers, labelled by action, image and runtime
+def write_prometheus_textfile(summaries, path):
+    # an image transferred more than once in the same run is reported by its latest transfer only: two samples
+    # with the same labels would make the node exporter reject the whole file
+    latest = {}
+    for summary in sorted(summaries, key=lambda s: s['started_at']):
+        latest[(summary['action'], summary['image'], summary['runtime'])] = summary
+    summaries = list(latest.values())
+
+    def labels(**values):
+        return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+                              .replace('\n', '\\n') + '"' for name, value in values.items()) + '}'
+
+    metrics = [
+        ('transfer_success', 'Whether the last pull or push of the image succeeded', lambda s: int(s['ok'])),
+        ('transfer_timestamp_seconds', 'Start time of the last pull or push of the image', lambda s: s['started_at']),
+        ('transfer_duration_seconds', 'Wall time of the last pull or push of the image', lambda s: s['elapsed']),
+        ('transfer_first_byte_seconds', 'Time to the first byte transferred by the last pull or push of the image',
+         lambda s: s['time_to_first_byte']),
+        ('transfer_bytes', 'Bytes of the layers transferred by the last pull or push of the image',
+         lambda s: s['bytes']),
+        ('transfer_throughput_bytes_per_second', 'Throughput of the last pull or push of the image',
+         lambda s: s['throughput']),
+    ]
+    layer_metrics = [
+        ('layer_transfer_bytes', 'Bytes of a layer transferred by the last pull or push of the image', 'bytes'),
+        ('layer_transfer_duration_seconds', 'Transfer time of a layer in the last pull or push of the image',
+         'duration'),
+        ('layer_transfer_throughput_bytes_per_second', 'Throughput of a layer in the last pull or push of the image',
+         'throughput'),
+    ]
+
+    lines = []
+    for name, description, value in metrics:
+        lines += ['# HELP ' + PROMETHEUS_PREFIX + name + ' ' + description,
+                  '# TYPE ' + PROMETHEUS_PREFIX + name + ' gauge']
+        for summary in summaries:
+            if value(summary) is not None:
+                lines.append(PROMETHEUS_PREFIX + name + labels(action=summary['action'], image=summary['image'],
+                                                               runtime=summary['runtime']) + ' ' + repr(value(summary)))
+    for name, description, field in layer_metrics:
+        lines += ['# HELP ' + PROMETHEUS_PREFIX + name + ' ' + description,
+                  '# TYPE ' + PROMETHEUS_PREFIX + name + ' gauge']
+        for summary in summaries:
+            for layer in summary['layers']:
+                if layer['status'] == 'transferred' and layer[field] is not None:
+                    lines.append(PROMETHEUS_PREFIX + name + labels(action=summary['action'], image=summary['image'],
+                                                                   runtime=summary['runtime'], layer=layer['id']) +
+                                 ' ' + repr(layer[field]))
+    write_file_atomically(path, '\n'.join(lines) + '\n')
+
+
+# END
+
+
+# Container runtime behind --containerruntime: docker and podman share the same command line for the image
+# actions, so pull, tag and push are implemented once here, both for a single image from the prompt and for a
+# list of images run concurrently. The actions go through the API socket of the runtime when it answers (api
+# 'auto' or 'socket') and through the cli otherwise (api 'cli', or no socket).
+class ContainerRuntime:
+    name = None
+
+    def __init__(self, name=None, api='auto', socket_path=None, transfer_stats=None, prometheus_textfile=None,
+                 force_push=False):
+        import threading
+        if name:
+            self.name = name
+        self.api = api
+        self.socket_path = socket_path
+        self.transfer_stats = transfer_stats
+        self.prometheus_textfile = prometheus_textfile
+        self.force_push = force_push
+        self.api_error = None
+        self._client = None
+        self._client_resolved = False
+        self._client_lock = threading.Lock()
+
+    # Client of the API socket, None when the actions run through the cli. The socket is probed once, with a
+    # ping; api_error tells why it can't be used.
+    @property
+    def client(self):
+        with self._client_lock:
+            if not self._client_resolved:
+                self._client_resolved = True
+                path = self.socket_path or runtime_socket_path(self.name)
+                if self.api == 'cli':
+                    pass
+                elif path is None:
+                    self.api_error = 'no API socket found for ' + self.name
+                else:
+                    client = RuntimeApiClient(path)
+                    try:
+                        client.request('GET', '/_ping')
+                        self._client = client
+                    except RuntimeApiError as e:
+                        self.api_error = 'the ' + self.name + ' API socket ' + path + ' is not available: ' + \
+                                         e.message
+            return self._client
+
+    def get_version(self):
+        return runcmd_version([self.name, '--version']).strip().decode()
+
+    # Path of the cli, or of the API socket when only the socket is available
     def is_installed(self):
         from shutil import which
-        return which('docker')
+        path = which(self.name)
+        if path is None and self.api != 'cli' and self.client is not None:
+            return self.client.socket_path
+        return path
+
+    # Translate the output of a failed action into the message printed to the user (None when it isn't known)
+    @staticmethod
+    def classify_error(action, message):
+        if action == 'pull':
+            if 'access denied' in message:
+                return ('ERROR: to pull this image, you must login. Use --aws option if is an ECR registry or '
+                        '--docker option for a Docker one.')
+            if 'not found' in message:
+                return ('ERROR: image URL is not correct or it doesn\'t exist. Verify that the repository name is '
+                        'correct.')
+            return None
+        if 'not a valid' in message:
+            return ('ERROR: the provided registry URL is not valid. Check the URL above and verify that its '
+                    'syntax is correct.')
+        if 'such image' in message or 'image not known' in message:
+            return 'ERROR: the provided image doesn\'t exist. Check the name and retry!'
+        return None
+
+    # Translate a RuntimeApiError into the message printed to the user: by its message first, like the output
+    # of the cli, then by its HTTP status
+    @classmethod
+    def classify_api_error(cls, action, error):
+        message = cls.classify_error(action, error.message.lower())
+        if message or error.status is None:
+            return message
+        if error.status in (401, 403):
+            return ('ERROR: to ' + action + ' this image, you must login. Use --aws option if is an ECR registry or '
+                    '--docker option for a Docker one.')
+        if error.status == 404:
+            return cls.classify_error(action, 'not found' if action == 'pull' else 'no such image')
+        return None
+
+    # Run an image action through the API socket and return its progress messages. progress is called with
+    # every message of the stream of a pull or push.
+    def api_image_action(self, action, images, progress=None):
+        if action == 'tag':
+            source, target = images
+            repo, tag = split_image_reference(target)
+            self.client.request('POST', '/images/' + source + '/tag', {'repo': repo, 'tag': tag})
+            return []
+        name, tag = split_image_reference(images[0])
+        headers = {'X-Registry-Auth': registry_auth_header(self.name, image_registry(name))}
+        if action == 'pull':
+            return self.client.stream('POST', '/images/create', {'fromImage': name, 'tag': tag}, headers, progress)
+        return self.client.stream('POST', '/images/' + name + '/push', {'tag': tag}, headers, progress)
+
+    # Run an image action ('pull', 'tag' or 'push') and return its result: {'action', 'image', 'ok', 'output',
+    # 'error', 'elapsed'}, where error is the classified message of a failure. Through the API socket the result
+    # has also the 'progress' messages of the action, each one passed to progress as soon as it is received.
+    # Pull and push have the 'transfer' summary of their TransferMeter (the wall time only through the cli).
+    def run_image_action(self, action, *images, progress=None):
+        start = time.time()
+        meter = TransferMeter(action, ' '.join(images), self.name)
+        result = {'action': action, 'image': ' '.join(images), 'ok': True, 'output': '', 'error': None}
+
+        def callback(message):
+            meter.update(message)
+            if progress:
+                progress(message)
+
+        if self.client is not None:
+            try:
+                result['progress'] = self.api_image_action(action, images, callback)
+                result['output'] = '\n'.join((message['id'] + ': ' if message.get('id') else '') + message['status']
+                                             for message in result['progress']
+                                             if message.get('status') and not message.get('progress'))
+            except RuntimeApiError as e:
+                result['ok'] = False
+                result['progress'] = e.progress
+                result['output'] = e.message
+                result['error'] = self.classify_api_error(action, e)
+        else:
+            res = runcmd_call([self.name, action] + list(images))
+            if type(res) == tuple:
+                result['ok'] = False
+                result['output'] = res[0].decode(errors='replace')
+                result['error'] = self.classify_error(action, result['output'])
+            else:
+                result['output'] = res.decode(errors='replace')
+        result['elapsed'] = time.time() - start
+        if action != 'tag':
+            result['transfer'] = meter.summary(result['ok'], result['elapsed'])
+        return result
+
+    # Write the transfer summaries of the pull and push results to the --transfer-stats and
+    # --prometheus-textfile files
+    def report_transfers(self, results):
+        summaries = [result['transfer'] for result in results if result.get('transfer')]
+        try:
+            if self.transfer_stats:
+                write_transfer_stats(summaries, self.transfer_stats)
+            if self.prometheus_textfile:
+                write_prometheus_textfile(summaries, self.prometheus_textfile)
+        except OSError as e:
+            print('WARN: the transfer metrics can\'t be written: ' + str(e))
 
     def pull_image(self):
         image = usr_inp('Insert the image URL you want to pull: ')
 
-        if image != '':
-            cmd = ['docker', 'pull', image]
-
         try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                if 'access denied' in error_message:
-                    print('ERROR: to pull this image, you must login. Use --aws option if is an ECR registry or '
-                          '--docker option for a Docker one.')
-                elif 'not found' in error_message:
-                    print('ERROR: image URL is not correct or it doesn\'t exist. Verify that the repository name is '
-                          'correct.')
+            if image == '':
+                raise ValueError('empty image')
+            result = self.run_image_action('pull', image, progress=print_progress)
+            if not result['ok']:
+                if result['error']:
+                    print(result['error'])
             else:
                 print('Image has been pulled successfully.')
+                print_transfer_report(result['transfer'])
+            self.report_transfers([result])
             sys.exit(0)
         except Exception as e:
             print('ABORT: Error in command running...')
@@ -275,18 +1019,11 @@ class Docker:
 
         registry = usr_inp('Insert the registry (specify a Docker or AWS ECR URL): ')
 
-        if image_name != '' or tag != '' or registry != '':
-            cmd = ['docker', 'tag', image_name, registry + '/' + image_name + ':' + tag]
-
         try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                if 'not a valid' in error_message:
-                    print('ERROR: the provided registry URL is not valid. Check the URL above and verify that its '
-                          'syntax is correct.')
-                elif 'such image':
-                    print('ERROR: the provided image doesn\'t exist. Check the name and retry!')
+            result = self.run_image_action('tag', image_name, registry + '/' + image_name + ':' + tag)
+            if not result['ok']:
+                if result['error']:
+                    print(result['error'])
             else:
                 print('Image was tagged successfully!')
             sys.exit(0)
@@ -301,37 +1038,115 @@ class Docker:
 
         registry = usr_inp('Insert the registry in which you want to push your image (Docker or AWS ECR): ')
 
-        if image_name != '' or tag != '' or registry != '':
-            cmd = ['docker', 'push', registry + '/' + image_name + ':' + tag]
-            print('\n::: DOCKER PUSH: ' + ' '.join(cmd) + ' ::: \n')
+        image = registry + '/' + image_name + ':' + tag
+        print('\n::: ' + self.name.upper() + ' PUSH: ' + ' '.join([self.name, 'push', image]) + ' ::: \n')
 
         try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                print(error_message)
-                if 'not a valid' in error_message:
-                    print('ERROR: the provided registry URL is not valid. Check the URL above and verify that its '
-                          'syntax is correct.')
-                elif 'such image':
-                    print('ERROR: the provided image doesn\'t exist. Check the name and retry!')
+            # an ECR image whose tag already has the local digest is not pushed again, unless forced
+            skip = {} if self.force_push else ecr_push_check(self, [image])
+            if image in skip:
+                print(skip[image][1])
+                sys.exit(0)
+            result = self.run_image_action('push', image, progress=print_progress)
+            if not result['ok']:
+                print(result['output'])
+                if result['error']:
+                    print(result['error'])
             else:
                 print('Image was pushed successfully!')
+                print_transfer_report(result['transfer'])
+            self.report_transfers([result])
             sys.exit(0)
         except Exception as e:
             print('ABORT: Error in command running...')
             sys.exit(1)
 
+    # Return the repository digests ('<repo>@sha256:...') of a local image: the digests it has been pushed or
+    # pulled with
+    def local_repo_digests(self, image):
+        if self.client is not None:
+            try:
+                return self.client.request('GET', '/images/' + image + '/json').get('RepoDigests') or []
+            except (RuntimeApiError, AttributeError):
+                return []
+        res = runcmd_call([self.name, 'image', 'inspect', '--format', '{{json .RepoDigests}}', image])
+        if type(res) == tuple:
+            return []
+        try:
+            return json.loads(res.decode()) or []
+        except ValueError:
+            return []
+
+    # Run an action on many images with at most workers of them at once. Every image is 'IMAGE' or, for tag,
+    # 'SOURCE=TARGET'. The images found in skip ({image: (ok, message)}) are not run and get that outcome. The
+    # results are printed image by image in the given order, as soon as they are available; returns the list of
+    # the results.
+    def bulk(self, action, images, workers=DEFAULT_WORKERS, skip=None):
+        from concurrent.futures import ThreadPoolExecutor
+        skip = skip or {}
+
+        def run(image):
+            if image in skip:
+                ok, message = skip[image]
+                return {'action': action, 'image': image, 'ok': ok, 'output': '', 'elapsed': 0.0,
+                        'error': None if ok else message, 'note': message if ok else None}
+            if action == 'tag':
+                source, _, target = image.partition('=')
+                if not target:
+                    return {'action': action, 'image': image, 'ok': False, 'output': '', 'elapsed': 0.0,
+                            'error': 'ERROR: the target of the tag is missing: use SOURCE=TARGET'}
+                return self.run_image_action(action, source, target)
+            return self.run_image_action(action, image)
+
+        print('INFO: ' + self.name + ' ' + action + ' of ' + str(len(images)) + ' images, ' + str(workers) +
+              ' at a time, through the ' + ('API socket ' + self.client.socket_path if self.client else 'cli'))
+        start = time.time()
+        results = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for result in executor.map(run, images):
+                results.append(result)
+                print('%-2s %-4s %-90s %7.1fs' % ('OK' if result['ok'] else 'KO', action, result['image'],
+                                                  result['elapsed']))
+                if not result['ok']:
+                    print('    ' + (result['error'] or 'ERROR: ' + ' '.join(result['output'].split()[-20:])))
+                elif result.get('note'):
+                    print('    ' + result['note'])
+                elif result.get('transfer') and result['transfer']['throughput']:
+                    transfer = result['transfer']
+                    print('    %s at %s/s, first byte after %.2fs' % (format_bytes(transfer['bytes']),
+                                                                     format_bytes(transfer['throughput']),
+                                                                     transfer['time_to_first_byte'] or 0))
+        failed = sum(1 for result in results if not result['ok'])
+        print('INFO: %d of %d images done in %.1fs, %d failed' % (len(results) - failed, len(results),
+                                                                 time.time() - start, failed))
+        self.report_transfers(results)
+        return results
 
-class Podman:
 
-    def __init__(self):
-        pass
+# Class to manage Docker
+class Docker(ContainerRuntime):
+    name = 'docker'
+
+    def get_version(self):
+        cmd = ['docker', '--version']
+        res = runcmd_version(cmd)
+        res = res.strip().decode().replace('Docker version ', '')
+
+        # version = float(res[0:8].strip()[:5])
+        #
+        # if version < 17.07:
+        #     sys.exit('WARN: The minimum Docker version supported to be able to use AWS-cli is 17.07. Update your '
+        #              'current version!')
+        return res
+
+
+class Podman(ContainerRuntime):
+    name = 'podman'
 
     def get_version(self):
         cmd = ['podman', '--version']
 
-        res = runcmd_call(cmd)
+        res = runcmd_version(cmd)
         res = res.strip().decode().replace('podman version', '').strip()
 
         # version = float(res)
@@ -342,86 +1157,17 @@ class Podman:
         #              'current version!')
         return res
 
-    def is_installed(self):
-        from shutil import which
-        return which('podman')
 
-    def pull_image(self):
-        image = usr_inp('Insert the image URL you want to pull: ')
-
-        if image != '':
-            cmd = ['podman', 'pull', image]
-
-        try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                if 'access denied' in error_message:
-                    print('ERROR: to pull this image, you must login. Use --aws option if is an ECR registry or '
-                          '--docker option for a Docker one.')
-                elif 'not found' in error_message:
-                    print('ERROR: image URL is not correct or it doesn\'t exist. Verify that the repository name is '
-                          'correct.')
-            else:
-                print('Image has been pulled successfully.')
-            sys.exit(0)
-        except Exception as e:
-            print('ABORT: Error in command running...')
-            sys.exit(1)
-
-    def tag_image(self):
-        image_name = usr_inp('Insert the image name you want to tag: ')
-
-        tag = usr_inp('Insert the tag you\'like to add to your image: ')
-
-        registry = usr_inp('Insert the registry (specify a Docker or AWS ECR URL): ')
-
-        if image_name != '' or tag != '' or registry != '':
-            cmd = ['podman', 'tag', image_name, registry + '/' + image_name + ':' + tag]
-
-        try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                if 'not a valid' in error_message:
-                    print('ERROR: the provided registry URL is not valid. Check the URL above and verify that its '
-                          'syntax is correct.')
-                elif 'such image':
-                    print('ERROR: the provided image doesn\'t exist. Check the name and retry!')
-            else:
-                print('Image was tagged successfully!')
-            sys.exit(0)
-        except Exception as e:
-            print('ABORT: Error in command running...')
-            sys.exit(1)
-
-    def push_image(self):
-        image_name = usr_inp('Insert the image name you want to push: ')
-
-        tag = usr_inp('Insert the image tag: ')
-
-        registry = usr_inp('Insert the registry in which you want to push your image (Docker or AWS ECR): ')
-
-        if image_name != '' or tag != '' or registry != '':
-            cmd = ['podman', 'push', registry + '/' + image_name + ':' + tag]
-            print('\n::: PODMAN PUSH: ' + ' '.join(cmd) + ' ::: \n')
-
-        try:
-            res = runcmd_call(cmd)
-            if type(res) == tuple and res[1] == 1:
-                error_message = res[0].decode()
-                print(error_message)
-                if 'not a valid' in error_message:
-                    print('ERROR: the provided registry URL is not valid. Check the URL above and verify that its '
-                          'syntax is correct.')
-                elif 'such image':
-                    print('ERROR: the provided image doesn\'t exist. Check the name and retry!')
-            else:
-                print('Image was pushed successfully!')
-            sys.exit(0)
-        except Exception as e:
-            print('ABORT: Error in command running...')
-            sys.exit(1)
+# Create the runtime of --containerruntime, --docker or --podman. With api 'socket' the API socket is required.
+def create_container_runtime(name, api='auto', socket_path=None, transfer_stats=None, prometheus_textfile=None,
+                             force_push=False):
+    runtime_class = Docker if name == 'docker' else Podman
+    container_runtime = runtime_class(api=api, socket_path=socket_path, transfer_stats=transfer_stats,
+                                      prometheus_textfile=prometheus_textfile, force_push=force_push)
+    if api == 'socket' and container_runtime.client is None:
+        print('ERROR: ' + container_runtime.api_error)
+        sys.exit(1)
+    return container_runtime
 
 
 # Class to manage S2I actions
@@ -432,7 +1178,7 @@ class S2I:
 
     def get_version(self):
         cmd = ['s2i', 'version']
-        res = runcmd_call(cmd)
+        res = runcmd_version(cmd)
         res = res.strip().decode().replace('s2i ', '')
 
         version = res[0:6].strip()
@@ -449,12 +1195,18 @@ class OC:
     def __init__(self):
         pass
 
+    # Only the client version is read: 'oc version' alone tries to reach the server too
     def get_version(self):
-        cmd = ['oc', 'version']
+        cmd = ['oc', 'version', '--client']
 
-        res = runcmd_call(cmd)
-        res = res[0].decode() if res is not None and type(res) is tuple else "No version available"
+        res = runcmd_version(cmd)
+        if res is None or type(res) is tuple:
+            return "No version available"
 
+        res = res.decode().strip()
+        for line in res.splitlines():
+            if line.startswith('Client Version:'):
+                return line.replace('Client Version:', '').strip()
         return res
 
     def is_installed(self):
@@ -462,13 +1214,1948 @@ class OC:
         return which('oc')
 
 
+### LOCAL CACHES
+# START
+
+# Registry hosting the ECR repositories managed by this script
+DEFAULT_ECR_REGISTRY = '350801433917.dkr.ecr.eu-west-1.amazonaws.com'
+
+# An ECR token is valid for 12 hours: a cached one is refreshed when it expires in less than this many seconds
+ECR_TOKEN_REFRESH_MARGIN = 30 * 60
+
+
+# Directory holding the caches of this script ($XDG_CACHE_HOME/ea-utilities), readable by the owner only
+def cache_dir():
+    import os
+    path = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                        'ea-utilities')
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+# Convert a timestamp of the ECR API to epoch seconds: the API returns epoch numbers, while the AWS cli
+# prints them as ISO 8601 strings
+def parse_aws_timestamp(value):
+    from datetime import datetime
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+# JSON document stored in the cache directory with permissions restricted to the owner. Writes go through a
+# temporary file that replaces the old one, so concurrent processes always read a complete document.
+class JsonCache:
+
+    def __init__(self, name):
+        import os
+        self.path = os.path.join(cache_dir(), name)
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, data):
+        import os
+        import tempfile
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.' + os.path.basename(self.path))
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    # Read, change and save the document holding an exclusive lock on the '<name>.lock' file next to it, so that
+    # processes updating different keys at once don't drop each other's changes. change gets the document and
+    # returns the new one, which is also returned.
+    def update(self, change):
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            data = change(self.load())
+            self.save(data)
+        return data
+
+
+# Registry passwords returned by GetAuthorizationToken, keyed by profile, region and registry, so that every
+# invocation in the 12 hours of validity of a token can reuse it
+class EcrTokenCache:
+
+    def __init__(self):
+        self.cache = JsonCache('ecr-tokens.json')
+
+    @staticmethod
+    def key(profile, region, registry):
+        return '|'.join([profile or '', region or '', registry])
+
+    # Return the cached entry ({'password', 'expiresAt'}) when it is still valid for at least margin seconds
+    def get(self, profile, region, registry, margin=ECR_TOKEN_REFRESH_MARGIN):
+        entry = self.cache.load().get(self.key(profile, region, registry))
+        if entry is not None and entry['expiresAt'] - margin > time.time():
+            return entry
+        return None
+
+    def put(self, profile, region, registry, password, expires_at):
+        new_entry = {'password': password, 'expiresAt': expires_at}
+
+        def change(data):
+            now = time.time()
+            data = {key: entry for key, entry in data.items() if entry['expiresAt'] > now}
+            data[self.key(profile, region, registry)] = new_entry
+            return data
+
+        self.cache.update(change)
+        return new_entry
+
+    # Return a valid entry for the registry, whatever profile and region it has been fetched with
+    def find(self, registry, margin=ECR_TOKEN_REFRESH_MARGIN):
+        for key, entry in self.cache.load().items():
+            if key.split('|')[-1] == registry and entry['expiresAt'] - margin > time.time():
+                return entry
+        return None
+
+    # Return the registries with a valid cached token
+    def registries(self):
+        return sorted(set(key.split('|')[-1] for key, entry in self.cache.load().items()
+                          if entry['expiresAt'] > time.time()))
+
+    def remove(self, registry):
+        self.cache.update(lambda data: {key: entry for key, entry in data.items()
+                                        if key.split('|')[-1] != registry})
+
+
+# Path of the file in which the container runtime stores the registry credentials after a login
+def runtime_auth_file(container_runtime):
+    import os
+    home = os.path.expanduser('~')
+    if container_runtime == 'podman':
+        candidates = [os.environ.get('REGISTRY_AUTH_FILE')]
+        if os.environ.get('XDG_RUNTIME_DIR'):
+            candidates.append(os.path.join(os.environ['XDG_RUNTIME_DIR'], 'containers', 'auth.json'))
+        candidates.append(os.path.join(home, '.config', 'containers', 'auth.json'))
+    else:
+        candidates = [os.path.join(os.environ.get('DOCKER_CONFIG') or os.path.join(home, '.docker'), 'config.json')]
+    for path in candidates:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+
+# Check whether the auth file of the container runtime already holds the given credential for the registry.
+# Credentials kept in an external store (credsStore) can't be checked, so they never match.
+def runtime_has_credential(container_runtime, registry, username, password):
+    import base64
+    path = runtime_auth_file(container_runtime)
+    if path is None:
+        return False
+    try:
+        with open(path) as auth_file:
+            auths = json.load(auth_file).get('auths', {})
+    except (OSError, ValueError):
+        return False
+    expected = base64.b64encode((username + ':' + password).encode()).decode()
+    return any(auths.get(name, {}).get('auth') == expected for name in (registry, 'https://' + registry))
+
+
+# Set to False by --no-cache to probe the tools at every run
+VERSION_CACHE_ENABLED = True
+
+
+# Run a version command of a tool, reusing the output cached for the same binary. The binary is identified by
+# its resolved path, mtime, inode and size, so it is probed again only after it has been updated or replaced.
+def runcmd_version(cmd):
+    import os
+    from shutil import which
+    path = which(cmd[0])
+    if not VERSION_CACHE_ENABLED or path is None:
+        return runcmd_call(cmd)
+
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    binary = [path, stat.st_mtime_ns, stat.st_ino, stat.st_size]
+    key = ' '.join(cmd)
+
+    cache = JsonCache('versions.json')
+    data = cache.load()
+    entry = data.get(key)
+    if entry is not None and entry['binary'] == binary:
+        return entry['output'].encode()
+
+    res = runcmd_call(cmd)
+    if type(res) != tuple:
+        data[key] = {'binary': binary, 'output': res.decode()}
+        cache.save(data)
+    return res
+
+
+# END
+
+### AWS PROFILES
+# START
+
+# Parsed AWS config and credentials files by path. An entry is reused until the (mtime, size) of its file
+# changes, so the files are parsed again only after they have been edited.
+_AWS_FILES_CACHE = {}
+
+
+# Path of the AWS config and credentials files, honouring AWS_CONFIG_FILE and AWS_SHARED_CREDENTIALS_FILE
+def aws_files_paths():
+    import os
+    config = os.environ.get('AWS_CONFIG_FILE') or os.path.join('~', '.aws', 'config')
+    credentials = os.environ.get('AWS_SHARED_CREDENTIALS_FILE') or os.path.join('~', '.aws', 'credentials')
+    return os.path.expanduser(config), os.path.expanduser(credentials)
+
+
+# Return the sections of an AWS ini file as a dict of dicts (empty when the file doesn't exist)
+def read_aws_file(path):
+    import configparser
+    import os
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _AWS_FILES_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    parser = configparser.RawConfigParser()
+    parser.read(path)
+    sections = {name: dict(parser.items(name)) for name in parser.sections()}
+    _AWS_FILES_CACHE[path] = (key, sections)
+    return sections
+
+
+# Resolve the settings of a profile in-process, with the same precedence of the AWS cli: environment variables,
+# then the credentials file ('[name]' sections), then the config file ('[profile name]', or '[default]').
+# The credentials in the environment apply to the default profile only, since a named profile always uses
+# its own keys: with them the default profile needs no files. Returns None when the profile is not configured.
+def resolve_aws_profile(profile_name):
+    import os
+    config_path, credentials_path = aws_files_paths()
+    config = read_aws_file(config_path)
+    credentials = read_aws_file(credentials_path)
+
+    section = 'default' if profile_name == 'default' else 'profile ' + profile_name
+    from_env = profile_name == 'default' and os.environ.get('AWS_ACCESS_KEY_ID')
+    if section not in config and profile_name not in credentials and not from_env:
+        return None
+
+    settings = dict(config.get(section, {}))
+    settings.update(credentials.get(profile_name, {}))
+
+    env = {'region': os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION'),
+           'output': os.environ.get('AWS_DEFAULT_OUTPUT')}
+    if profile_name == 'default' and os.environ.get('AWS_ACCESS_KEY_ID'):
+        env['aws_access_key_id'] = os.environ.get('AWS_ACCESS_KEY_ID')
+        env['aws_secret_access_key'] = os.environ.get('AWS_SECRET_ACCESS_KEY')
+        env['aws_session_token'] = os.environ.get('AWS_SESSION_TOKEN')
+    settings.update({name: value for name, value in env.items() if value})
+    return settings
+
+
+# Set keys of a section of an AWS ini file in place, like 'aws configure set': the lines of the keys are
+# replaced, the missing keys are added at the end of the section (or in a new section at the end of the file)
+# and every other line, comments and formatting included, is kept as it is. The new content is written to a
+# temporary file in the same directory, with the mode of the file (0600 when new), whose path is returned: the
+# caller moves it into place.
+def prepare_aws_file(path, section, values):
+    import os
+    import re
+    import stat
+    import tempfile
+
+    try:
+        with open(path, newline='') as aws_file:
+            lines = aws_file.read().splitlines(True)
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        lines = []
+        mode = 0o600
+    newline = '\r\n' if lines and lines[0].endswith('\r\n') else '\n'
+    header = re.compile(r'^\s*\[\s*([^\]]+?)\s*\]')
+
+    # the lines of the section are lines[start:end]
+    start = end = None
+    for i, line in enumerate(lines):
+        match = header.match(line)
+        if match is None:
+            continue
+        if start is not None:
+            end = i
+            break
+        if match.group(1) == section:
+            start = i + 1
+    if start is None:
+        if lines and not lines[-1].endswith(('\n', '\r')):
+            lines[-1] += newline
+        if lines and lines[-1].strip():
+            lines.append(newline)
+        lines.append('[' + section + ']' + newline)
+        start = end = len(lines)
+    elif end is None:
+        end = len(lines)
+
+    # only the top level keys: the indented lines are the values of the nested settings (e.g. s3)
+    missing = dict(values)
+    key = re.compile(r'^([^=:\s#;\[]+)\s*[=:]')
+    for i in range(start, end):
+        match = key.match(lines[i])
+        if match and match.group(1) in missing:
+            ending = lines[i][len(lines[i].rstrip('\r\n')):] or newline
+            lines[i] = match.group(1) + ' = ' + missing.pop(match.group(1)) + ending
+    position = end
+    while position > start and not lines[position - 1].strip():
+        position -= 1
+    if position > 0 and not lines[position - 1].endswith(('\n', '\r')):
+        lines[position - 1] += newline
+    lines[position:position] = [name + ' = ' + value + newline for name, value in missing.items()]
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w', newline='') as tmp_file:
+            tmp_file.write(''.join(lines))
+        os.chmod(tmp_path, mode)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+# Store a profile in both the AWS files: the keys in the credentials file and the other settings in the config
+# one. Only the lines of the profile change. Both files are read, prepared and moved into place holding an
+# exclusive lock on the '<credentials>.lock' file, so that concurrent set-profile runs don't drop each other's
+# changes, and nothing is replaced until both new files are ready. The credentials file is replaced first:
+# a profile is found through either file, so if the process dies between the two replaces the profile has its
+# new keys with the previous region and output (set-profile can simply be run again), never a config pointing
+# to stale or missing keys.
+def store_aws_profile(profile_name, access_key_id, secret_access_key, region, output):
+    import os
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    config_path, credentials_path = aws_files_paths()
+    for path in (config_path, credentials_path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+
+    section = 'default' if profile_name == 'default' else 'profile ' + profile_name
+    with open(credentials_path + '.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        tmp_credentials = prepare_aws_file(credentials_path, profile_name,
+                                           {'aws_access_key_id': access_key_id,
+                                            'aws_secret_access_key': secret_access_key})
+        try:
+            tmp_config = prepare_aws_file(config_path, section, {'region': region, 'output': output})
+        except Exception:
+            os.remove(tmp_credentials)
+            raise
+        os.replace(tmp_credentials, credentials_path)
+        os.replace(tmp_config, config_path)
+
+
+# END
+
+### ECR BACKENDS
+# START
+
+# Version of the ECR JSON API, used as prefix of the X-Amz-Target header
+ECR_API_TARGET = 'AmazonEC2ContainerRegistry_V20150921'
+
+# Host name of an ECR registry, the region is its first group
+ECR_REGISTRY_PATTERN = r'^\d{12}\.dkr\.ecr\.([a-z0-9-]+)\.amazonaws\.com(\.cn)?$'
+
+# Max number of image ids accepted by a single ECR BatchGetImage call
+ECR_BATCH_GET_MAX = 100
+
+# Manifest media types accepted by BatchGetImage: the manifests are returned as they have been pushed
+ECR_MANIFEST_MEDIA_TYPES = ['application/vnd.docker.distribution.manifest.v2+json',
+                            'application/vnd.docker.distribution.manifest.list.v2+json',
+                            'application/vnd.oci.image.manifest.v1+json',
+                            'application/vnd.oci.image.index.v1+json']
+
+# Requests per second allowed to each ECR API by the client side rate limiter, kept below the per-account
+# quotas of ECR. The actions not listed here get ECR_DEFAULT_RATE.
+ECR_API_RATES = {
+    'BatchDeleteImage': 20,
+    'BatchGetImage': 100,
+    'DescribeImages': 20,
+    'DescribeImageScanFindings': 20,
+    'DescribeRepositories': 20,
+    'GetAuthorizationToken': 20,
+    'ListImages': 20,
+    'PutImage': 10,
+}
+ECR_DEFAULT_RATE = 10
+
+# Error codes meaning that the request has been throttled by AWS and can be retried as-is
+ECR_THROTTLING_CODES = ('ThrottlingException', 'Throttling', 'TooManyRequestsException', 'RequestLimitExceeded',
+                        'ThrottledException', 'RequestThrottledException', '429')
+
+# Retries of a throttled request, with full-jitter exponential backoff between ECR_BACKOFF_BASE and
+# ECR_BACKOFF_MAX seconds
+ECR_MAX_RETRIES = 8
+ECR_BACKOFF_BASE = 0.2
+ECR_BACKOFF_MAX = 20.0
+
+
+# Error returned by an ECR backend. The code is the AWS error code (e.g. 'RepositoryNotFoundException') or,
+# when it can't be detected, the return code of the AWS cli.
+class EcrError(Exception):
+
+    def __init__(self, code, message=''):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return str(self.code) + ': ' + self.message
+
+
+# Token bucket shared by all the threads calling an API: a request takes a token, the bucket refills at rate
+# tokens per second up to burst. The rate adapts to the throttling: it is halved every time a request is
+# throttled and grows back by 5% per successful request, up to the configured rate.
+class TokenBucket:
+
+    def __init__(self, rate, burst=None):
+        import threading
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take a token, sleeping until one is available. Returns the seconds spent waiting.
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(1.0, self.rate / 2)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.05)
+
+
+# Client side rate limiter of an ECR backend: one token bucket per API plus the statistics of the calls
+# (requests, throttled responses, retries, seconds spent waiting for a token or backing off), so that the
+# number of workers can be tuned on the observed request rate.
+class EcrRateLimiter:
+
+    def __init__(self, rates=None):
+        import threading
+        self.rates = dict(ECR_API_RATES, **(rates or {}))
+        self.buckets = {}
+        self.stats = {}
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def bucket(self, action):
+        with self.lock:
+            if action not in self.buckets:
+                self.buckets[action] = TokenBucket(self.rates.get(action, ECR_DEFAULT_RATE))
+                self.stats[action] = {'requests': 0, 'throttled': 0, 'retries': 0, 'failed': 0, 'waited': 0.0}
+            return self.buckets[action]
+
+    def count(self, action, key, value=1):
+        with self.lock:
+            self.stats[action][key] += value
+
+    # Run request() under the rate limit of the action. A throttled request is retried after a full-jitter
+    # exponential backoff; any other error is raised immediately, like a throttling that outlasts the retries.
+    def run(self, action, request):
+        import random
+        bucket = self.bucket(action)
+        for attempt in range(ECR_MAX_RETRIES + 1):
+            self.count(action, 'waited', bucket.acquire())
+            self.count(action, 'requests')
+            try:
+                response = request()
+            except EcrError as e:
+                if str(e.code) not in ECR_THROTTLING_CODES:
+                    self.count(action, 'failed')
+                    raise
+                self.count(action, 'throttled')
+                bucket.throttled()
+                if attempt == ECR_MAX_RETRIES:
+                    self.count(action, 'failed')
+                    raise
+                delay = random.uniform(0, min(ECR_BACKOFF_MAX, ECR_BACKOFF_BASE * 2 ** attempt))
+                self.count(action, 'retries')
+                self.count(action, 'waited', delay)
+                time.sleep(delay)
+                continue
+            bucket.succeeded()
+            return response
+
+    # Print one line per API with the observed request rate and the retries
+    def print_stats(self, stream=sys.stderr):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self.lock:
+            stats = sorted(self.stats.items())
+            rates = dict((action, bucket.rate) for action, bucket in self.buckets.items())
+        print('INFO: ECR API calls in %.1fs:' % elapsed, file=stream)
+        for action, stat in stats:
+            print('    %-28s %6d requests %7.1f req/s (limit %5.1f) %5d throttled %5d retries %4d failed %7.1fs waited'
+                  % (action, stat['requests'], stat['requests'] / elapsed, rates[action], stat['throttled'],
+                     stat['retries'], stat['failed'], stat['waited']), file=stream)
+
+
+# Split an image of an ECR registry ('<account>.dkr.ecr.<region>.amazonaws.com/<repo>:<tag>') into
+# (registry, region, repo, tag). Returns None for the images of the other registries and the ones without a tag.
+def parse_ecr_image(image):
+    import re
+    registry, _, name = image.partition('/')
+    host = re.match(ECR_REGISTRY_PATTERN, registry)
+    if host is None or '@' in name or ':' not in name:
+        return None
+    repo, tag = name.rsplit(':', 1)
+    return registry, host.group(1), repo, tag
+
+
+# Base class of the ECR backends: each operation builds the request of the ECR JSON API and hands it to
+# _invoke(), which returns the decoded response or raises an EcrError. The calls of all the threads sharing a
+# backend go through its rate limiter.
+class EcrBackend:
+    name = None
+
+    def __init__(self, profile=None, region=None, endpoint_url=None):
+        self.profile = profile
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.limiter = EcrRateLimiter()
+
+    # Run an ECR API action. When a label is given, the request is printed as debug message first.
+    def call(self, action, payload, label=None):
+        if label:
+            print('::: ' + label + ': ' + self.describe(action, payload) + ' ::: \n')
+        return self.limiter.run(action, lambda: self._invoke(action, payload))
+
+    def describe(self, action, payload):
+        raise NotImplementedError
+
+    def _invoke(self, action, payload):
+        raise NotImplementedError
+
+    def list_images(self, repo, tag_status=None, next_token=None, max_results=1000, label=None):
+        payload = {'repositoryName': repo, 'maxResults': max_results}
+        if tag_status:
+            payload['filter'] = {'tagStatus': tag_status}
+        if next_token:
+            payload['nextToken'] = next_token
+        return self.call('ListImages', payload, label)
+
+    def batch_delete_image(self, repo, image_ids, label=None):
+        return self.call('BatchDeleteImage', {'repositoryName': repo, 'imageIds': image_ids}, label)
+
+    def describe_repositories(self, repo_names=None, next_token=None, max_results=1000, label=None):
+        payload = {}
+        if repo_names:
+            payload['repositoryNames'] = repo_names
+        else:
+            payload['maxResults'] = max_results
+        if next_token:
+            payload['nextToken'] = next_token
+        return self.call('DescribeRepositories', payload, label)
+
+    def describe_images(self, repo, image_ids=None, next_token=None, max_results=1000, label=None):
+        payload = {'repositoryName': repo}
+        if image_ids:
+            payload['imageIds'] = image_ids
+        else:
+            payload['maxResults'] = max_results
+        if next_token:
+            payload['nextToken'] = next_token
+        return self.call('DescribeImages', payload, label)
+
+    def create_repository(self, repo, mutability='MUTABLE', scan_on_push=True, label=None):
+        return self.call('CreateRepository', {'repositoryName': repo, 'imageTagMutability': mutability,
+                                              'imageScanningConfiguration': {'scanOnPush': scan_on_push}}, label)
+
+    def delete_repository(self, repo, force=False, label=None):
+        return self.call('DeleteRepository', {'repositoryName': repo, 'force': force}, label)
+
+    def get_authorization_token(self, label=None):
+        return self.call('GetAuthorizationToken', {}, label)
+
+    def batch_get_image(self, repo, image_ids, media_types=None, label=None):
+        payload = {'repositoryName': repo, 'imageIds': image_ids}
+        if media_types:
+            payload['acceptedMediaTypes'] = media_types
+        return self.call('BatchGetImage', payload, label)
+
+    def put_image(self, repo, manifest, tag=None, media_type=None, digest=None, label=None):
+        payload = {'repositoryName': repo, 'imageManifest': manifest}
+        if tag:
+            payload['imageTag'] = tag
+        if media_type:
+            payload['imageManifestMediaType'] = media_type
+        if digest:
+            payload['imageDigest'] = digest
+        return self.call('PutImage', payload, label)
+
+    def describe_image_scan_findings(self, repo, digest, next_token=None, max_results=1000, label=None):
+        payload = {'repositoryName': repo, 'imageId': {'imageDigest': digest}, 'maxResults': max_results}
+        if next_token:
+            payload['nextToken'] = next_token
+        return self.call('DescribeImageScanFindings', payload, label)
+
+    def get_lifecycle_policy(self, repo, label=None):
+        return self.call('GetLifecyclePolicy', {'repositoryName': repo}, label)
+
+    def put_lifecycle_policy(self, repo, policy_text, label=None):
+        return self.call('PutLifecyclePolicy', {'repositoryName': repo, 'lifecyclePolicyText': policy_text}, label)
+
+
+# ECR backend spawning the AWS cli: every call is a separate 'aws ecr' process. The request is passed as-is
+# with --cli-input-json, so both backends share the same payloads and responses.
+class EcrCliBackend(EcrBackend):
+    name = 'cli'
+
+    def command(self, action, payload):
+        import re
+        cmd = ['aws', 'ecr', re.sub('(?<!^)([A-Z])', r'-\1', action).lower(), '--cli-input-json',
+               json.dumps(payload), '--output', 'json', '--no-paginate']
+        if self.profile:
+            cmd += ['--profile', self.profile]
+        if self.region:
+            cmd += ['--region', self.region]
+        if self.endpoint_url:
+            cmd += ['--endpoint-url', self.endpoint_url]
+        return cmd
+
+    def describe(self, action, payload):
+        return ' '.join(self.command(action, payload))
+
+    def _invoke(self, action, payload):
+        import re
+        try:
+            p = subprocess.run(self.command(action, payload), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            raise EcrError('CliNotAvailable', str(e))
+
+        if p.returncode != 0:
+            message = p.stderr.decode(errors='replace').strip()
+            code = re.search(r'An error occurred \((\w+)\)', message)
+            raise EcrError(code.group(1) if code else p.returncode, message)
+
+        try:
+            return json.loads(p.stdout.decode() or '{}')
+        except ValueError:
+            raise EcrError('InvalidResponse', 'unable to parse the AWS cli output')
+
+
+# ECR backend talking to the ECR JSON API in-process: requests are signed with AWS Signature V4 and sent
+# over keep-alive HTTPS connections that are reused across calls and threads.
+class EcrHttpBackend(EcrBackend):
+    name = 'http'
+
+    def __init__(self, profile=None, region=None, endpoint_url=None, access_key=None, secret_key=None,
+                 session_token=None, pool_size=DEFAULT_WORKERS):
+        super().__init__(profile, region, endpoint_url)
+        from urllib.parse import urlsplit
+        import queue
+
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        url = urlsplit(endpoint_url or 'https://api.ecr.' + region + '.amazonaws.com')
+        self.scheme = url.scheme or 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or '/'
+        self.netloc = url.netloc
+        self.pool = queue.LifoQueue(maxsize=max(1, pool_size))
+
+    def _get_connection(self):
+        import http.client
+        import queue
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            if self.scheme == 'http':
+                return http.client.HTTPConnection(self.host, self.port, timeout=60)
+            return http.client.HTTPSConnection(self.host, self.port, timeout=60)
+
+    def _put_connection(self, conn):
+        import queue
+        try:
+            self.pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def sign(self, action, body):
+        import hashlib
+        import hmac
+
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        datestamp = amz_date[:8]
+        headers = {'content-type': 'application/x-amz-json-1.1', 'host': self.netloc, 'x-amz-date': amz_date,
+                   'x-amz-target': ECR_API_TARGET + '.' + action}
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+
+        signed_headers = ';'.join(sorted(headers))
+        canonical_request = '\n'.join(['POST', self.path, '',
+                                       ''.join(k + ':' + headers[k] + '\n' for k in sorted(headers)),
+                                       signed_headers, hashlib.sha256(body).hexdigest()])
+        scope = datestamp + '/' + self.region + '/ecr/aws4_request'
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                                    hashlib.sha256(canonical_request.encode()).hexdigest()])
+
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (datestamp, self.region, 'ecr', 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers['authorization'] = ('AWS4-HMAC-SHA256 Credential=' + self.access_key + '/' + scope +
+                                    ', SignedHeaders=' + signed_headers + ', Signature=' + signature)
+        return headers
+
+    def describe(self, action, payload):
+        return 'POST ' + self.scheme + '://' + self.netloc + self.path + ' ' + action + ' ' + json.dumps(payload)
+
+    def _invoke(self, action, payload):
+        import http.client
+        body = json.dumps(payload).encode()
+
+        # a pooled connection may have been closed by the server while idle: retry once on a fresh one
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                conn.request('POST', self.path, body, self.sign(action, body))
+                rsp = conn.getresponse()
+                data = rsp.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                conn.close()
+                if attempt == 1:
+                    raise EcrError('ConnectionError', str(e))
+        self._put_connection(conn)
+
+        try:
+            response = json.loads(data.decode() or '{}')
+        except ValueError:
+            response = {'message': data.decode(errors='replace')}
+        if rsp.status >= 400:
+            code = response.get('__type', str(rsp.status)).split('#')[-1]
+            raise EcrError(code, response.get('message', response.get('Message', '')))
+        return response
+
+
+# END
+
+
+### ECR INVENTORY
+# START
+
+# Max number of image ids accepted by a single ECR DescribeImages call
+ECR_DESCRIBE_IMAGES_MAX = 100
+
+# Max age in seconds of the inventory of a repository purged with --from-inventory, when --inventory-ttl is 0
+INVENTORY_PURGE_MAX_AGE = 3600
+
+
+# Local SQLite copy of the repositories and images of the registries, so that the listings can be answered
+# without calling ECR. The rows of each registry are kept under a scope ('<profile>@<region>'), and every
+# repository stores the fingerprint of its last listing to detect whether its content has changed.
+class EcrInventory:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS repositories (
+            scope TEXT NOT NULL,
+            name TEXT NOT NULL,
+            fingerprint TEXT,
+            refreshed_at REAL,
+            PRIMARY KEY (scope, name)
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            scope TEXT NOT NULL,
+            repo TEXT NOT NULL,
+            digest TEXT NOT NULL,
+            tags TEXT NOT NULL DEFAULT '',
+            size INTEGER,
+            pushed_at REAL,
+            PRIMARY KEY (scope, repo, digest)
+        );
+        CREATE INDEX IF NOT EXISTS images_by_tags ON images (scope, tags);
+    """
+
+    def __init__(self, scope, path=None):
+        import os
+        import sqlite3
+        self.scope = scope
+        self.path = path or os.path.join(cache_dir(), 'inventory.sqlite')
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(self.SCHEMA)
+
+    # Open the inventory only if it has already been created by an 'inventory-refresh'
+    @classmethod
+    def open_existing(cls, scope):
+        import os
+        if not os.path.exists(os.path.join(cache_dir(), 'inventory.sqlite')):
+            return None
+        return cls(scope)
+
+    # Return {repository name: (fingerprint, refreshed_at)} for the scope
+    def repositories(self):
+        rows = self.db.execute('SELECT name, fingerprint, refreshed_at FROM repositories WHERE scope = ?',
+                               (self.scope,))
+        return {name: (fingerprint, refreshed_at) for name, fingerprint, refreshed_at in rows}
+
+    def digests(self, repo):
+        rows = self.db.execute('SELECT digest FROM images WHERE scope = ? AND repo = ?', (self.scope, repo))
+        return set(digest for digest, in rows)
+
+    # Store the new listing of a repository: tags maps every digest to its tags, details maps the digests
+    # that are new to the inventory to their (size, pushed_at)
+    def update_repository(self, repo, fingerprint, tags, details):
+        with self.db:
+            known = self.digests(repo)
+            self.db.executemany('DELETE FROM images WHERE scope = ? AND repo = ? AND digest = ?',
+                                [(self.scope, repo, digest) for digest in known - set(tags)])
+            self.db.executemany('UPDATE images SET tags = ? WHERE scope = ? AND repo = ? AND digest = ?',
+                                [(','.join(sorted(tags[digest])), self.scope, repo, digest)
+                                 for digest in known & set(tags)])
+            self.db.executemany('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                                [(self.scope, repo, digest, ','.join(sorted(tags[digest])), size, pushed_at)
+                                 for digest, (size, pushed_at) in details.items()])
+            self.db.execute('INSERT OR REPLACE INTO repositories VALUES (?, ?, ?, ?)',
+                            (self.scope, repo, fingerprint, time.time()))
+
+    def remove_repositories(self, names):
+        with self.db:
+            for name in names:
+                self.db.execute('DELETE FROM images WHERE scope = ? AND repo = ?', (self.scope, name))
+                self.db.execute('DELETE FROM repositories WHERE scope = ? AND name = ?', (self.scope, name))
+
+    # Forget the digests deleted by a purge. The fingerprint is reset, so the next refresh checks the repository.
+    def remove_digests(self, repo, digests):
+        with self.db:
+            self.db.executemany('DELETE FROM images WHERE scope = ? AND repo = ? AND digest = ?',
+                                [(self.scope, repo, digest) for digest in digests])
+            self.db.execute('UPDATE repositories SET fingerprint = NULL WHERE scope = ? AND name = ?',
+                            (self.scope, repo))
+
+    # Untagged images of the snapshot repositories (or of a single repository) as (repo, digest, size, pushed_at)
+    def untagged_images(self, repo=None):
+        if repo is not None:
+            return self.db.execute('SELECT repo, digest, size, pushed_at FROM images '
+                                   'WHERE scope = ? AND tags = \'\' AND repo = ? ORDER BY pushed_at',
+                                   (self.scope, repo)).fetchall()
+        return self.db.execute('SELECT repo, digest, size, pushed_at FROM images WHERE scope = ? AND tags = \'\' '
+                               'AND lower(repo) LIKE \'%snapshot%\' ORDER BY repo, pushed_at',
+                               (self.scope,)).fetchall()
+
+    # Repositories by total size as (repo, images, bytes), the largest first
+    def largest_repositories(self, limit):
+        return self.db.execute('SELECT repo, count(*), coalesce(sum(size), 0) AS bytes FROM images WHERE scope = ? '
+                               'GROUP BY repo ORDER BY bytes DESC LIMIT ?', (self.scope, limit)).fetchall()
+
+
+# In-memory columns of the images of one or more repositories, for the listings too large to be kept as JSON
+# dicts or lists of strings. Every image is a row: the digest is stored as 32 raw bytes, the repository and the
+# tags as ids of interned strings, the size and the timestamps in typed arrays. The tags of row i are
+# tag_ids[tag_offsets[i]:tag_offsets[i + 1]].
+class ImageInventory:
+
+    def __init__(self):
+        from array import array
+        self.repo_names, self.repo_index = [], {}
+        self.tag_names, self.tag_index = [], {}
+        self.digests = bytearray()
+        self.repo_ids = array('I')
+        self.sizes = array('Q')
+        self.pushed_at = array('d')
+        self.pulled_at = array('d')
+        self.tag_offsets = array('I', [0])
+        self.tag_ids = array('I')
+
+    def __len__(self):
+        return len(self.repo_ids)
+
+    @staticmethod
+    def intern(value, names, index):
+        if value not in index:
+            index[value] = len(names)
+            names.append(value)
+        return index[value]
+
+    # Add an image: the timestamps are epoch seconds (0 when unknown)
+    def add(self, repo, digest, tags=(), size=0, pushed_at=0, pulled_at=0):
+        self.digests += bytes.fromhex(digest.split(':', 1)[-1])
+        self.repo_ids.append(self.intern(repo, self.repo_names, self.repo_index))
+        self.sizes.append(size or 0)
+        self.pushed_at.append(pushed_at or 0)
+        self.pulled_at.append(pulled_at or 0)
+        for tag in tags:
+            self.tag_ids.append(self.intern(tag, self.tag_names, self.tag_index))
+        self.tag_offsets.append(len(self.tag_ids))
+
+    # Add the imageDetails of describe-images (any iterable, also a lazy one)
+    def add_details(self, details, repo=None):
+        for image in details:
+            self.add(image.get('repositoryName', repo), image['imageDigest'], image.get('imageTags', ()),
+                     image.get('imageSizeInBytes'), parse_aws_timestamp(image.get('imagePushedAt')),
+                     parse_aws_timestamp(image.get('lastRecordedPullTime')))
+
+    def digest(self, row):
+        return 'sha256:' + self.digests[row * 32:row * 32 + 32].hex()
+
+    def digest_key(self, row):
+        return bytes(self.digests[row * 32:row * 32 + 32])
+
+    def repo(self, row):
+        return self.repo_names[self.repo_ids[row]]
+
+    def tags(self, row):
+        return [self.tag_names[tag_id] for tag_id in self.tag_ids[self.tag_offsets[row]:self.tag_offsets[row + 1]]]
+
+    def rows(self):
+        return range(len(self))
+
+    def untagged(self, rows=None):
+        offsets = self.tag_offsets
+        return [row for row in (self.rows() if rows is None else rows) if offsets[row] == offsets[row + 1]]
+
+    # Rows with at least a tag matching the regular expression, which is evaluated once per distinct tag. The tag
+    # column is scanned once and every matching position is mapped back to its row.
+    def with_tags_matching(self, pattern, rows=None):
+        import re
+        from bisect import bisect_right
+        regex = re.compile(pattern)
+        matching = set(tag_id for tag_id, tag in enumerate(self.tag_names) if regex.search(tag))
+        offsets = self.tag_offsets
+        found = sorted(set(bisect_right(offsets, position) - 1
+                           for position, tag_id in enumerate(self.tag_ids) if tag_id in matching))
+        if rows is None:
+            return found
+        found = set(found)
+        return [row for row in rows if row in found]
+
+    # Rows whose digest isn't the digest of any of the other rows (e.g. untagged minus protected): the digests
+    # are compared as 32 bytes keys
+    def difference(self, rows, other_rows):
+        with memoryview(self.digests) as digests:
+            others = set(digests[row * 32:row * 32 + 32].tobytes() for row in other_rows)
+            return [row for row in rows if digests[row * 32:row * 32 + 32].tobytes() not in others]
+
+    # Rows sorted by push time, the oldest first
+    def sorted_by_age(self, rows=None, newest_first=False):
+        return sorted(self.rows() if rows is None else rows, key=self.pushed_at.__getitem__, reverse=newest_first)
+
+# END
+
+### PURGE JOURNAL
+# START
+
+# Append-only log of the purge-images-all runs of a scope ('<profile>@<region>'), one JSON record per line:
+#   {"run": id, "event": "start"|"resume"|"end", "at": epoch}
+#   {"run": id, "event": "batch", "repo": name, "deleted": [digests], "failed": [digests]}
+#   {"run": id, "event": "done", "repo": name, "count": untagged images found}
+# Every record is flushed to disk before the next batch is sent, so a run killed at any point can be resumed from
+# its last record, and the file keeps the deleted digests of all the runs for auditing.
+class PurgeJournal:
+
+    def __init__(self, scope):
+        import os
+        import threading
+        self.path = os.path.join(cache_dir(), 'purge-journal-' + scope.replace(os.sep, '_') + '.jsonl')
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.run = None
+        self.completed = set()
+        self.deleted = set()
+
+    # Group the records of the journal by run, in order: a record truncated by a crash is ignored
+    def runs(self):
+        runs = {}
+        try:
+            with open(self.path) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    run = runs.setdefault(record['run'], {'run': record['run'], 'started': None, 'ended': None,
+                                                          'repos': {}})
+                    if record['event'] == 'start':
+                        run['started'] = record['at']
+                    elif record['event'] == 'end':
+                        run['ended'] = record['at']
+                    elif record['event'] in ('batch', 'done'):
+                        repo = run['repos'].setdefault(record['repo'], {'deleted': [], 'failed': [], 'done': False})
+                        if record['event'] == 'batch':
+                            repo['deleted'] += record['deleted']
+                            repo['failed'] += record['failed']
+                        else:
+                            repo['done'] = True
+        except OSError:
+            pass
+        return list(runs.values())
+
+    # Start a new run or, when resume is set and the last run didn't end, continue it: the repositories it has
+    # completed and the digests it has deleted are then available in completed and deleted. Returns True when
+    # an interrupted run is resumed.
+    def start(self, resume=False):
+        import os
+        runs = self.runs()
+        last = runs[-1] if runs else None
+        resumed = resume and last is not None and last['ended'] is None
+        if resumed:
+            self.run = last['run']
+            self.completed = set(repo for repo, info in last['repos'].items() if info['done'])
+            self.deleted = set(digest for info in last['repos'].values() for digest in info['deleted'])
+        else:
+            self.run = time.strftime('%Y%m%dT%H%M%S') + '-' + str(os.getpid())
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.journal_file = os.fdopen(fd, 'a')
+        self.append({'event': 'resume' if resumed else 'start', 'at': time.time()})
+        return resumed
+
+    def append(self, record):
+        import os
+        record = dict(record, run=self.run)
+        with self.lock:
+            self.journal_file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def record_batch(self, repo, deleted, failures):
+        self.append({'event': 'batch', 'repo': repo, 'deleted': deleted,
+                     'failed': [digest for digest, code, reason in failures]})
+
+    # A repository is completed only when all its untagged images have been deleted: otherwise a resumed run
+    # tries it again
+    def record_repo(self, repo, count):
+        self.append({'event': 'done', 'repo': repo, 'count': count})
+
+    def finish(self):
+        self.append({'event': 'end', 'at': time.time()})
+        self.close()
+
+    def close(self):
+        self.journal_file.close()
+
+
+# END
+
+### REPOSITORY MANIFEST
+# START
+
+# Read a manifest file: YAML when it has a .yml/.yaml extension (that needs PyYAML), JSON otherwise
+def load_manifest_document(path):
+    with open(path) as manifest_file:
+        text = manifest_file.read()
+    if path.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('PyYAML is needed to read ' + path + ': install it or use a JSON manifest')
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+# Load the images of a bulk action from --images (comma separated, or @FILE with one image per line and '#'
+# comments) and from a --manifest, whose document is a list, or an {"images": [...]} object, of image names or of
+# {"image": ..., "target": ...} objects (the target is the new name of a tag). Returns 'IMAGE' or
+# 'SOURCE=TARGET' items.
+def load_image_list(images=None, manifest=None):
+    items = []
+    if images and images.startswith('@'):
+        with open(images[1:]) as images_file:
+            items += [line.split('#', 1)[0].strip() for line in images_file]
+    elif images:
+        items += [item.strip() for item in images.split(',')]
+    if manifest:
+        document = load_manifest_document(manifest)
+        if isinstance(document, dict):
+            document = document.get('images', [])
+        for item in document or []:
+            if isinstance(item, dict):
+                item = item['image'] + ('=' + item['target'] if item.get('target') else '')
+            items.append(str(item).strip())
+    return [item for item in items if item]
+
+# Load a manifest of repositories, in JSON or YAML (the latter needs PyYAML). The document is a list, or a
+# {"repositories": [...]} object, whose items are either a repository name or an object:
+#   {"name": "products/org/product", "mutability": "IMMUTABLE", "scanOnPush": true, "snapshot": true}
+# Like create-repo, every product is a release repository plus a '-snapshot' one (unless "snapshot" is false).
+# Returns the repositories to manage as {name: {'mutability', 'scanOnPush', 'lifecycle'}}, in manifest order.
+def load_repository_manifest(path):
+    document = load_manifest_document(path)
+    if isinstance(document, dict):
+        document = document.get('repositories', [])
+
+    repositories = {}
+    for item in document or []:
+        if not isinstance(item, dict):
+            item = {'name': item}
+        name = str(item['name']).strip()
+        scan_on_push = bool(item.get('scanOnPush', True))
+        repositories[name] = {'mutability': item.get('mutability', 'IMMUTABLE'), 'scanOnPush': scan_on_push,
+                              'lifecycle': False}
+        if item.get('snapshot', True):
+            repositories[name + '-snapshot'] = {'mutability': 'MUTABLE', 'scanOnPush': scan_on_push,
+                                                'lifecycle': True}
+    return repositories
+
+# END
+
+### OUTPUT FORMATS
+# START
+
+# Width of the columns of the table format (the other fields get OUTPUT_TABLE_WIDTH)
+OUTPUT_TABLE_WIDTHS = {'imageDigest': 71, 'repositoryName': 50, 'imageTag': 24, 'imageTags': 30}
+OUTPUT_TABLE_WIDTH = 20
+
+
+# Write a stream of records (dicts) as soon as they are produced, in one of the output formats:
+#   json    a single document {"<key>": [records]}, written record by record
+#   ndjson  one JSON record per line
+#   table   one aligned row per record, with a header
+# fields (--fields) selects and orders the keys of the records, otherwise the records are written whole. The
+# table has the fields as columns, or the fixed columns of the command (by default the keys of the first
+# record). Nothing is kept in memory, so the output of a listing of any size starts with its first page.
+class RecordWriter:
+
+    def __init__(self, output_format='json', fields=None, key='records', stream=sys.stdout, columns=None):
+        self.output_format = output_format
+        self.fields = fields
+        self.columns = fields or columns
+        self.key = key
+        self.stream = stream
+        self.count = 0
+
+    def write(self, record):
+        if self.fields:
+            record = {field: record.get(field) for field in self.fields}
+
+        if self.output_format == 'ndjson':
+            self.stream.write(json.dumps(record) + '\n')
+        elif self.output_format == 'table':
+            if self.columns is None:
+                self.columns = list(record)
+            if self.count == 0:
+                self.stream.write(self.row(self.columns) + '\n')
+            self.stream.write(self.row(['-' if record.get(field) is None else
+                                        ','.join(record[field]) if isinstance(record[field], list) else
+                                        record[field] for field in self.columns]) + '\n')
+        else:
+            self.stream.write((',\n' if self.count else '{\n    "' + self.key + '": [\n') + '        ' +
+                              json.dumps(record))
+        self.count += 1
+
+    def row(self, values):
+        return ' '.join(str(value).ljust(max(len(field), OUTPUT_TABLE_WIDTHS.get(field, OUTPUT_TABLE_WIDTH)))
+                        for field, value in zip(self.columns, values)).rstrip()
+
+    def close(self):
+        if self.output_format == 'json':
+            self.stream.write('\n    ]\n}\n' if self.count else '{\n    "' + self.key + '": []\n}\n')
+        self.stream.flush()
+
+# END
+
 # Class to manage AWS actions
 class Aws:
 
-    def __init__(self, aws_props_lists=None, aws_prof_name=None, container_runtime=None):
+    def __init__(self, aws_props_lists=None, aws_prof_name=None, container_runtime=None, workers=DEFAULT_WORKERS,
+                 ecr_backend='auto', endpoint_url=None, from_inventory=False, untagged_days=DEFAULT_UNTAGGED_DAYS,
+                 keep_tagged=DEFAULT_KEEP_TAGGED, resume=False, registry=DEFAULT_ECR_REGISTRY, output_format=None,
+                 fields=None, stale_days=DEFAULT_STALE_DAYS, keep_last=DEFAULT_KEEP_LAST, protect_tags=None,
+                 dry_run=False, inventory_ttl=0):
         self.aws_props_lists = aws_props_lists
         self.aws_prof_name = aws_prof_name
         self.container_runtime = container_runtime
+        self.workers = max(1, workers)
+        self.ecr_backend = ecr_backend
+        self.endpoint_url = endpoint_url
+        self.from_inventory = from_inventory
+        self.inventory_ttl = inventory_ttl
+        self.untagged_days = untagged_days
+        self.keep_tagged = keep_tagged
+        self.resume = resume
+        self.registry = registry
+        self.output_format = output_format
+        self.fields = fields
+        self.stale_days = stale_days
+        self.keep_last = keep_last
+        self.protect_tags = protect_tags
+        self.dry_run = dry_run
+        self._ecr = None
+
+    # ECR backend used by all the repository and image actions, created on first use from the loaded profile
+    @property
+    def ecr(self):
+        if self._ecr is None:
+            self._ecr = self.create_ecr_backend()
+        return self._ecr
+
+    # The 'http' backend talks to the ECR API in-process and needs the static credentials of the profile, the
+    # 'cli' one spawns the AWS cli for each call. 'auto' picks the first one when the profile allows it.
+    def create_ecr_backend(self):
+        import os
+        props = dict(self.aws_props_lists or [])
+        region = props.get('region') or os.environ.get('AWS_REGION') or os.environ.get('AWS_DEFAULT_REGION')
+        access_key = props.get('aws_access_key_id')
+        secret_key = props.get('aws_secret_access_key')
+        has_credentials = bool(access_key and secret_key and region)
+
+        if self.ecr_backend == 'http' and not has_credentials:
+            print('ERROR: The http ECR backend needs a profile with access key, secret key and region. '
+                  'Use \'--ecr-backend cli\' for the other profiles.')
+            sys.exit(1)
+        if self.ecr_backend == 'http' or (self.ecr_backend == 'auto' and has_credentials):
+            return EcrHttpBackend(self.aws_prof_name, region, self.endpoint_url, access_key, secret_key,
+                                  props.get('aws_session_token'), pool_size=self.workers)
+        if self.ecr_backend == 'auto' and not self.is_installed():
+            print('ERROR: The profile has no static credentials and AWS-cli is not installed in the current '
+                  'system. To install it, check this link: '
+                  'https://docs.aws.amazon.com/en_us/cli/latest/userguide/install-cliv2.html')
+            sys.exit(1)
+        return EcrCliBackend(self.aws_prof_name, region, self.endpoint_url)
+
+    # The AWS cli is needed by the cli ECR backend and by the commands that run it. With 'auto' the backend is
+    # known only once the profile is loaded, so create_ecr_backend checks the cli when it falls back to it.
+    def needs_cli(self, command):
+        return self.ecr_backend == 'cli' or command in ('get-current-profile', 'version')
+
+    # Print the details of an ECR error, following the format of the messages for the AWS cli return codes
+    def print_ecr_error(self, error):
+        print('Error code: ' + str(error.code))
+        if error.message:
+            print('Error message: ' + error.message)
+        print('Checkout the documentation for AWS cli 2: '
+              'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
+
+    # Yield the image ids of a repository (optionally filtered by tag status) page by page, following the
+    # nextToken: the caller can start working on the first page while the next ones are still to be fetched.
+    # The debug label is printed for the first request only.
+    def iter_image_ids(self, repo, tag_status=None, label=None):
+        next_token = None
+        while True:
+            response = self.ecr.list_images(repo, tag_status, next_token, label=label)
+            label = None
+            yield from response.get('imageIds', [])
+            next_token = response.get('nextToken')
+            if not next_token:
+                return
+
+    # Yield the repositories of the registry page by page, following the nextToken
+    def iter_repositories(self, label=None):
+        next_token = None
+        while True:
+            response = self.ecr.describe_repositories(next_token=next_token, label=label)
+            label = None
+            yield from response.get('repositories', [])
+            next_token = response.get('nextToken')
+            if not next_token:
+                return
+
+    # Yield the details (size, tags, push time, ...) of the images of a repository page by page
+    def iter_image_details(self, repo, label=None):
+        next_token = None
+        while True:
+            response = self.ecr.describe_images(repo, next_token=next_token, label=label)
+            label = None
+            yield from response.get('imageDetails', [])
+            next_token = response.get('nextToken')
+            if not next_token:
+                return
+
+    # Lifecycle policy of the snapshot repositories: ECR expires the untagged images older than untagged_days and
+    # the tagged images beyond the keep_tagged most recent ones (a value of 0 disables the rule)
+    def snapshot_lifecycle_policy(self):
+        rules = []
+        if self.untagged_days > 0:
+            rules.append({'rulePriority': len(rules) + 1,
+                          'description': 'Expire untagged images older than %d days' % self.untagged_days,
+                          'selection': {'tagStatus': 'untagged', 'countType': 'sinceImagePushed',
+                                        'countUnit': 'days', 'countNumber': self.untagged_days},
+                          'action': {'type': 'expire'}})
+        if self.keep_tagged > 0:
+            rules.append({'rulePriority': len(rules) + 1,
+                          'description': 'Keep the last %d tagged images' % self.keep_tagged,
+                          'selection': {'tagStatus': 'tagged', 'tagPatternList': ['*'],
+                                        'countType': 'imageCountMoreThan', 'countNumber': self.keep_tagged},
+                          'action': {'type': 'expire'}})
+        return json.dumps({'rules': rules}, indent=2, sort_keys=True)
+
+    # Compare the lifecycle policy of a repository with the expected one. Returns (repo, status, diff lines),
+    # where the status is 'up-to-date', 'missing' or 'differs'.
+    def diff_lifecycle_policy(self, repo, expected):
+        import difflib
+        try:
+            current = self.ecr.get_lifecycle_policy(repo)['lifecyclePolicyText']
+        except EcrError as e:
+            if e.code != 'LifecyclePolicyNotFoundException':
+                return repo, 'error', [str(e)]
+            return repo, 'missing', []
+
+        current = json.dumps(json.loads(current), indent=2, sort_keys=True)
+        if current == expected:
+            return repo, 'up-to-date', []
+        return repo, 'differs', list(difflib.unified_diff(current.splitlines(), expected.splitlines(),
+                                                          'current', 'expected', lineterm=''))
+
+    # Generate, diff or apply the lifecycle policy of all the snapshot repositories. The repositories are
+    # checked concurrently and the policy is written only where it is missing or different.
+    def lifecycle(self, action):
+        from concurrent.futures import ThreadPoolExecutor
+        expected = self.snapshot_lifecycle_policy()
+        if action == 'generate':
+            print(expected)
+            return 0
+
+        try:
+            repos = [repo['repositoryName'] for repo in self.iter_repositories(label='LIST-REPOS')
+                     if 'snapshot' in repo['repositoryName'].lower()]
+        except EcrError as e:
+            print('ERROR: Error while retrieving the repositories!')
+            self.print_ecr_error(e)
+            return -1
+
+        counts = {}
+        to_apply = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo, status, diff in executor.map(lambda name: self.diff_lifecycle_policy(name, expected), repos):
+                counts[status] = counts.get(status, 0) + 1
+                print('%-60s %s' % (repo, status))
+                for line in diff:
+                    print('    ' + line)
+                if status in ('missing', 'differs'):
+                    to_apply.append(repo)
+        print('INFO: ' + ', '.join('%d %s' % (count, status) for status, count in sorted(counts.items())))
+
+        # the repositories whose policy couldn't be read make the command fail
+        failed = counts.get('error', 0)
+        if action != 'apply' or not to_apply:
+            return -1 if failed else 0
+        rsp = usr_inp('Do you want to apply the lifecycle policy to ' + str(len(to_apply)) +
+                      ' repositories?[yes|NO] ') or 'no'
+        if rsp != 'yes':
+            print('ABORT: User denied...')
+            sys.exit(1)
+
+        def apply(repo):
+            try:
+                self.ecr.put_lifecycle_policy(repo, expected)
+                return repo, None
+            except EcrError as e:
+                return repo, e
+
+        applied = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo, error in executor.map(apply, to_apply):
+                if error is None:
+                    applied += 1
+                    print('INFO: Lifecycle policy applied to ' + repo)
+                else:
+                    failed += 1
+                    print('ERROR: Cannot apply the lifecycle policy to ' + repo + ': ' + str(error))
+        print('INFO: Lifecycle policy applied to %d of %d repositories' % (applied, len(to_apply)))
+        return -1 if failed else 0
+
+    # Scope of the rows of this registry in the local inventory
+    def inventory_scope(self):
+        return (self.aws_prof_name or 'default') + '@' + dict(self.aws_props_lists or []).get('region', '')
+
+    # List a repository and compare the listing with the fingerprint stored in the inventory: only when the
+    # repository has changed, the details of the images unknown to the inventory are described. Runs in a
+    # worker thread, so the inventory is updated afterwards by the caller.
+    def scan_repository(self, repo, fingerprint, known):
+        import hashlib
+        tags = {}
+        for image in self.iter_image_ids(repo):
+            tags.setdefault(image['imageDigest'], [])
+            if 'imageTag' in image:
+                tags[image['imageDigest']].append(image['imageTag'])
+
+        listing = '\n'.join(sorted(digest + ' ' + ','.join(sorted(tags[digest])) for digest in tags))
+        new_fingerprint = hashlib.sha256(listing.encode()).hexdigest()
+        result = {'repo': repo, 'changed': new_fingerprint != fingerprint, 'fingerprint': new_fingerprint,
+                  'tags': tags, 'details': {}, 'removed': len(known - set(tags))}
+        if not result['changed']:
+            return result
+
+        new_digests = [digest for digest in tags if digest not in known]
+        for i in range(0, len(new_digests), ECR_DESCRIBE_IMAGES_MAX):
+            image_ids = [{'imageDigest': digest} for digest in new_digests[i:i + ECR_DESCRIBE_IMAGES_MAX]]
+            try:
+                details = self.ecr.describe_images(repo, image_ids).get('imageDetails', [])
+            except EcrError as e:
+                if e.code != 'ImageNotFoundException':
+                    raise
+                # an image has been deleted in the meantime: describe the others one by one
+                details = []
+                for image_id in image_ids:
+                    try:
+                        details += self.ecr.describe_images(repo, [image_id]).get('imageDetails', [])
+                    except EcrError:
+                        pass
+            for detail in details:
+                result['details'][detail['imageDigest']] = (detail.get('imageSizeInBytes'),
+                                                            parse_aws_timestamp(detail.get('imagePushedAt')))
+
+        # the digests that couldn't be described aren't stored: without a fingerprint the repository is listed
+        # and the missing digests are described again by the next refresh
+        result['missing'] = len(set(new_digests) - set(result['details']))
+        if result['missing']:
+            result['fingerprint'] = None
+        return result
+
+    # Refresh the local inventory incrementally: every repository is listed (ListImages returns the ids only),
+    # the unchanged ones are skipped and only the new images of the changed ones are described. Repositories
+    # refreshed less than ttl seconds ago are not listed at all.
+    def inventory_refresh(self, ttl=0):
+        from concurrent.futures import ThreadPoolExecutor
+        inventory = EcrInventory(self.inventory_scope())
+        stored = inventory.repositories()
+        start = time.time()
+        counts = {'unchanged': 0, 'updated': 0, 'fresh': 0, 'errors': 0}
+
+        try:
+            names = [repo['repositoryName'] for repo in self.iter_repositories(label='LIST-REPOS')]
+        except EcrError as e:
+            print('ERROR: Error while retrieving the repositories!')
+            self.print_ecr_error(e)
+            return -1
+        inventory.remove_repositories(set(stored) - set(names))
+
+        to_scan = [name for name in names if name not in stored or stored[name][1] is None or
+                   stored[name][1] < start - ttl or stored[name][0] is None]
+        counts['fresh'] = len(names) - len(to_scan)
+
+        def scan(name):
+            try:
+                return self.scan_repository(name, stored.get(name, (None, None))[0], inventory_digests[name])
+            except EcrError as e:
+                return {'repo': name, 'error': e}
+
+        inventory_digests = {name: inventory.digests(name) for name in to_scan}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result in executor.map(scan, to_scan):
+                if 'error' in result:
+                    counts['errors'] += 1
+                    print('ERROR: ' + result['repo'] + ': ' + str(result['error']))
+                elif result['changed']:
+                    counts['updated'] += 1
+                    inventory.update_repository(result['repo'], result['fingerprint'], result['tags'],
+                                                result['details'])
+                    print('INFO: ' + result['repo'] + ': updated (' + str(len(result['details'])) + ' new, ' +
+                          str(result['removed']) + ' removed images)')
+                    if result['missing']:
+                        print('WARN: ' + result['repo'] + ': ' + str(result['missing']) + ' images not described, '
+                              'they will be retried by the next refresh')
+                else:
+                    counts['unchanged'] += 1
+                    inventory.update_repository(result['repo'], result['fingerprint'], result['tags'], {})
+
+        print('INFO: Inventory refreshed in %.1fs: %d repositories updated, %d unchanged, %d skipped (refreshed '
+              'less than %ds ago), %d errors' % (time.time() - start, counts['updated'], counts['unchanged'],
+                                                 counts['fresh'], ttl, counts['errors']))
+        print('INFO: Inventory stored in ' + inventory.path)
+        return 0
+
+    def inventory_query(self, query, limit):
+        inventory = EcrInventory.open_existing(self.inventory_scope())
+        if inventory is None:
+            print('ERROR: The inventory is empty. Run \'--aws inventory-refresh\' first.')
+            sys.exit(1)
+
+        # with --format the rows are written as records
+        if self.output_format is not None:
+            if query == 'untagged-snapshot':
+                writer = RecordWriter(self.output_format, self.fields, 'images',
+                                      columns=['repositoryName', 'imageDigest', 'imageSizeInBytes', 'imagePushedAt'])
+            else:
+                writer = RecordWriter(self.output_format, self.fields, 'repositories',
+                                      columns=['repositoryName', 'images', 'bytes'])
+            if query == 'untagged-snapshot':
+                rows = inventory.untagged_images()
+                for repo, digest, size, pushed_at in rows[:limit] if limit else rows:
+                    writer.write({'repositoryName': repo, 'imageDigest': digest, 'imageSizeInBytes': size,
+                                  'imagePushedAt': pushed_at})
+            elif query == 'largest-repos':
+                for repo, images, size in inventory.largest_repositories(limit or 20):
+                    writer.write({'repositoryName': repo, 'images': images, 'bytes': size})
+            writer.close()
+            return 0
+
+        if query == 'untagged-snapshot':
+            rows = inventory.untagged_images()
+            for repo, digest, size, pushed_at in rows[:limit] if limit else rows:
+                print('%-60s %s %12s %s' % (repo, digest, size,
+                                            time.strftime('%Y-%m-%d %H:%M', time.localtime(pushed_at or 0))))
+            print('INFO: %d untagged images, %d bytes' % (len(rows), sum(row[2] or 0 for row in rows)))
+        elif query == 'largest-repos':
+            for repo, images, size in inventory.largest_repositories(limit or 20):
+                print('%-60s %8d images %16d bytes' % (repo, images, size))
+        return 0
+
+    # Describe all the images of a repository and summarize its storage: total bytes, the bytes reclaimed by each
+    # purge strategy and its top_k largest images. Only bounded heaps are kept, whatever the number of images.
+    def scan_repository_storage(self, repo, top_k, protect=None):
+        import heapq
+        summary = {'repo': repo, 'images': 0, 'bytes': 0, 'untagged': 0, 'lifecycle': 0, 'stale': 0, 'top': []}
+        snapshot = 'snapshot' in repo.lower()
+        expire_before = time.time() - self.untagged_days * 86400
+        stale_before = time.time() - self.stale_days * 86400
+        recent_tagged = []
+        recent = []
+
+        for image in self.iter_image_details(repo):
+            size = image.get('imageSizeInBytes') or 0
+            pushed_at = parse_aws_timestamp(image.get('imagePushedAt')) or 0
+            pulled_at = parse_aws_timestamp(image.get('lastRecordedPullTime')) or 0
+            summary['images'] += 1
+            summary['bytes'] += size
+
+            entry = (size, image['imageDigest'], ','.join(image.get('imageTags', [])))
+            if len(summary['top']) < top_k:
+                heapq.heappush(summary['top'], entry)
+            elif entry > summary['top'][0]:
+                heapq.heapreplace(summary['top'], entry)
+
+            if not snapshot:
+                continue
+            if not image.get('imageTags'):
+                summary['untagged'] += size
+                if self.untagged_days > 0 and pushed_at < expire_before:
+                    summary['lifecycle'] += size
+            elif self.keep_tagged > 0:
+                # the keep_tagged most recent tagged images are kept, any older one expires
+                heapq.heappush(recent_tagged, (pushed_at, size))
+                if len(recent_tagged) > self.keep_tagged:
+                    summary['lifecycle'] += heapq.heappop(recent_tagged)[1]
+
+            # prune-stale keeps the keep_last most recent images: any older one not pulled (or pushed) in the last
+            # stale_days is stale, unless it has a protected tag
+            protected = protect is not None and any(protect.search(tag) for tag in image.get('imageTags', []))
+            heapq.heappush(recent, (pushed_at, max(pushed_at, pulled_at), size, protected))
+            if len(recent) > self.keep_last:
+                last_activity, stale_size, protected = heapq.heappop(recent)[1:]
+                if last_activity < stale_before and not protected:
+                    summary['stale'] += stale_size
+        return summary
+
+    # Report the storage of the registry: every repository is described concurrently, and only the per-repository
+    # totals and the top_k largest images are kept. The bytes reclaimed by purge-images-all (untagged snapshot
+    # images), by the lifecycle policy (--untagged-days, --keep-tagged) and by prune-stale (--stale-days,
+    # --keep-last, --protect-tags, on the last pull times) are estimated on the same data.
+    def storage_report(self, top_k=0):
+        import heapq
+        import re
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        top_k = top_k or 20
+        totals = []
+        largest = []
+        start = time.time()
+        try:
+            protect = re.compile(self.protect_tags) if self.protect_tags else None
+        except re.error as e:
+            print('ERROR: Invalid --protect-tags regular expression: ' + str(e))
+            return -1
+
+        def scan(name):
+            try:
+                return self.scan_repository_storage(name, top_k, protect)
+            except EcrError as e:
+                return {'repo': name, 'error': e}
+
+        def collect(summary):
+            if 'error' in summary:
+                print('ERROR: ' + summary['repo'] + ': ' + str(summary['error']))
+                return
+            totals.append((summary['bytes'], summary['repo'], summary['images'], summary['untagged'],
+                           summary['lifecycle'], summary['stale']))
+            for entry in summary['top']:
+                entry = (entry[0], summary['repo'], entry[1], entry[2])
+                if len(largest) < top_k:
+                    heapq.heappush(largest, entry)
+                elif entry > largest[0]:
+                    heapq.heapreplace(largest, entry)
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for repo in self.iter_repositories(label='LIST-REPOS'):
+                    pending.append(executor.submit(scan, repo['repositoryName']))
+                    while pending and (pending[0].done() or len(pending) > 2 * self.workers):
+                        collect(pending.popleft().result())
+            except EcrError as e:
+                print('ERROR: Error while retrieving the repositories!')
+                self.print_ecr_error(e)
+            while pending:
+                collect(pending.popleft().result())
+
+        totals.sort(reverse=True)
+        print('###################### REPOSITORIES BY SIZE')
+        print('%-60s %8s %12s %14s %14s %14s' % ('REPOSITORY', 'IMAGES', 'SIZE', 'UNTAGGED', 'LIFECYCLE', 'STALE'))
+        for size, repo, images, untagged, lifecycle, stale in totals:
+            print('%-60s %8d %12s %14s %14s %14s' % (repo, images, format_bytes(size), format_bytes(untagged),
+                                                     format_bytes(lifecycle), format_bytes(stale)))
+        print()
+        print('###################### LARGEST ' + str(top_k) + ' IMAGES')
+        for size, repo, digest, tags in sorted(largest, reverse=True):
+            print('%12s %-60s %s %s' % (format_bytes(size), repo, digest, tags or '<untagged>'))
+        print()
+        print('###################### RECLAIMABLE STORAGE')
+        total = sum(row[0] for row in totals)
+        for strategy, reclaimed in (('purge-images-all (untagged snapshot images)', sum(row[3] for row in totals)),
+                                    ('lifecycle policy (untagged > %d days, tagged beyond the last %d)'
+                                     % (self.untagged_days, self.keep_tagged), sum(row[4] for row in totals)),
+                                    ('prune-stale (not pulled in %d days, beyond the last %d)'
+                                     % (self.stale_days, self.keep_last), sum(row[5] for row in totals))):
+            print('%-70s %12s (%.1f%%)' % (strategy, format_bytes(reclaimed),
+                                           100.0 * reclaimed / total if total else 0))
+        print('INFO: %d repositories, %d images, %s in %.1fs' % (len(totals), sum(row[2] for row in totals),
+                                                                 format_bytes(total), time.time() - start))
+        return 0
+
+    # Return the scan results of the latest images of a repository as (repo, {digest: result}, cache hits),
+    # where a result is {'status', 'counts': {severity: findings}}. The results found in cached (keyed by digest)
+    # are not fetched again; only the severity counts are read, so a single findings page is requested.
+    def scan_repository_findings(self, repo, latest, cached):
+        import heapq
+        images = heapq.nlargest(latest, ((parse_aws_timestamp(image.get('imagePushedAt')) or 0, image['imageDigest'])
+                                         for image in self.iter_image_details(repo)))
+        results, hits = {}, 0
+        for pushed_at, digest in images:
+            if digest in cached:
+                results[digest] = cached[digest]
+                hits += 1
+                continue
+            try:
+                response = self.ecr.describe_image_scan_findings(repo, digest, max_results=1)
+                findings = response.get('imageScanFindings', {})
+                results[digest] = {'status': response.get('imageScanStatus', {}).get('status', 'UNKNOWN'),
+                                   'counts': findings.get('findingSeverityCounts', {})}
+            except EcrError as e:
+                if e.code != 'ScanNotFoundException':
+                    raise
+                results[digest] = {'status': 'NOT_SCANNED', 'counts': {}}
+        return repo, results, hits
+
+    # Report the scan findings of the latest images (by push time) of every repository, with one severity summary
+    # per repository. The image content never changes for a given digest, so the completed scans are cached
+    # permanently by digest and a new report only queries the digests pushed since the last one.
+    def scan_report(self, latest=0):
+        from concurrent.futures import ThreadPoolExecutor
+        latest = latest or 1
+        cache = JsonCache('scan-findings.json')
+        cached = cache.load()
+        start = time.time()
+
+        try:
+            repos = [repo['repositoryName'] for repo in self.iter_repositories(label='LIST-REPOS')]
+        except EcrError as e:
+            print('ERROR: Error while retrieving the repositories!')
+            self.print_ecr_error(e)
+            return -1
+
+        def scan(name):
+            try:
+                return self.scan_repository_findings(name, latest, cached)
+            except EcrError as e:
+                return name, e, 0
+
+        columns = ' '.join('%' + str(max(8, len(severity))) + '{0}' for severity in SCAN_SEVERITIES)
+        print(('%-60s %6s ' + columns.format('s') + ' %11s') % (('REPOSITORY', 'IMAGES') + SCAN_SEVERITIES +
+                                                                ('NOT SCANNED',)))
+        totals = dict.fromkeys(SCAN_SEVERITIES, 0)
+        queried = hits = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo, results, repo_hits in executor.map(scan, repos):
+                if isinstance(results, EcrError):
+                    print('ERROR: ' + repo + ': ' + str(results))
+                    continue
+                hits += repo_hits
+                queried += len(results) - repo_hits
+                counts = dict.fromkeys(SCAN_SEVERITIES, 0)
+                for digest, result in results.items():
+                    if result['status'] == 'COMPLETE':
+                        cached[digest] = result
+                    for severity, count in result['counts'].items():
+                        counts[severity] = counts.get(severity, 0) + count
+                        totals[severity] = totals.get(severity, 0) + count
+                not_scanned = sum(1 for result in results.values() if result['status'] != 'COMPLETE')
+                print(('%-60s %6d ' + columns.format('d') + ' %11d') % ((repo, len(results)) +
+                                                                        tuple(counts[s] for s in SCAN_SEVERITIES) +
+                                                                        (not_scanned,)))
+        cache.save(cached)
+        print('INFO: ' + ', '.join('%d %s' % (totals[s], s) for s in SCAN_SEVERITIES) + ' findings')
+        print('INFO: %d repositories in %.1fs: %d scans queried, %d from the cache' % (len(repos), time.time() - start,
+                                                                                      queried, hits))
+        return 0
+
+    # Yield (repo, [(digest, size, tags)]) for every repository, from the inventory or from describe-images with
+    # the repositories described concurrently and yielded as soon as they are complete
+    def iter_repository_images(self):
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        if self.from_inventory:
+            inventory = EcrInventory.open_existing(self.inventory_scope())
+            if inventory is None:
+                raise EcrError('InventoryNotFound', 'the inventory is empty: run \'--aws inventory-refresh\' first')
+            for repo in sorted(inventory.repositories()):
+                yield repo, inventory.db.execute('SELECT digest, size, tags FROM images WHERE scope = ? AND repo = ?',
+                                                 (inventory.scope, repo)).fetchall()
+            return
+
+        def describe(name):
+            return name, [(image['imageDigest'], image.get('imageSizeInBytes') or 0,
+                           ','.join(image.get('imageTags', []))) for image in self.iter_image_details(name)]
+
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo in self.iter_repositories(label='LIST-REPOS'):
+                pending.append(executor.submit(describe, repo['repositoryName']))
+                while pending and (pending[0].done() or len(pending) > 2 * self.workers):
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    # Report the digests stored in more than one repository. The index maps the 32 bytes of every digest to the
+    # index of its first repository, its size and tags: only the digests seen again get the list of the other
+    # repositories, so the index stays small on registries with hundreds of thousands of images.
+    def duplicates_report(self, limit=0):
+        start = time.time()
+        repos = []
+        first = {}
+        others = {}
+        images = 0
+        try:
+            for repo, repo_images in self.iter_repository_images():
+                repos.append(repo)
+                index = len(repos) - 1
+                for digest, size, tags in repo_images:
+                    images += 1
+                    key = bytes.fromhex(digest.split(':', 1)[-1])
+                    if key not in first:
+                        first[key] = (index, size or 0, tags)
+                    elif first[key][0] != index:
+                        others.setdefault(key, []).append((index, tags))
+        except EcrError as e:
+            print('ERROR: Error while retrieving the images!')
+            self.print_ecr_error(e)
+            return -1
+
+        # every extra copy is counted once more in the storage of the repositories
+        duplicates = sorted(((first[key][1] * len(copies), key) for key, copies in others.items()), reverse=True)
+        print('###################### DUPLICATED DIGESTS')
+        for extra_bytes, key in duplicates[:limit or 20]:
+            index, size, tags = first[key]
+            print('sha256:' + key.hex() + ' ' + format_bytes(size) + ' in ' + str(len(others[key]) + 1) +
+                  ' repositories')
+            for repo_index, repo_tags in [(index, tags)] + others[key]:
+                print('    %-60s %s' % (repos[repo_index], repo_tags or '<untagged>'))
+
+        def is_pair(repo, other):
+            return repo == other + '-snapshot' or other == repo + '-snapshot'
+        pairs = sum(1 for key, copies in others.items()
+                    if any(is_pair(repos[first[key][0]], repos[index]) for index, tags in copies))
+        print()
+        print('INFO: %d images in %d repositories, %d unique digests in %.1fs' % (images, len(repos), len(first),
+                                                                                 time.time() - start))
+        print('INFO: %d digests stored in more than one repository (%d release/snapshot pairs): %s counted more '
+              'than once' % (len(others), pairs, format_bytes(sum(extra for extra, key in duplicates))))
+        return 0
+
+    # Compare the images about to be pushed to a repository with the ECR ones: tags maps every tag to the
+    # repository digests of its local image. All the tags are read with BatchGetImage in batches, and the
+    # repository mutability with one DescribeRepositories. Returns {tag: (ok, message)} for the tags that don't
+    # need a push: the ones already in ECR with the local digest, and the ones of an IMMUTABLE repository that
+    # already hold another digest (the push would fail).
+    def check_pushes(self, repo, tags):
+        immutable = self.ecr.describe_repositories([repo])['repositories'][0].get('imageTagMutability') == 'IMMUTABLE'
+        names = list(tags)
+        remote = {}
+        for i in range(0, len(names), ECR_BATCH_GET_MAX):
+            response = self.ecr.batch_get_image(repo, [{'imageTag': tag} for tag in names[i:i + ECR_BATCH_GET_MAX]])
+            for image in response.get('images', []):
+                remote[image['imageId'].get('imageTag')] = image['imageId']['imageDigest']
+
+        results = {}
+        for tag, local_digests in tags.items():
+            if tag not in remote:
+                continue
+            if any(digest.endswith('@' + remote[tag]) for digest in local_digests):
+                results[tag] = (True, 'INFO: already present (' + remote[tag] + '), push skipped')
+            elif immutable:
+                results[tag] = (False, 'ERROR: the tag is already present with another digest (' + remote[tag] +
+                                ') and the repository is IMMUTABLE')
+        return results
+
+    # Registry host of a repository, from its repositoryUri: the registry of the account and region of the
+    # profile, not the default --registry. A --registry given explicitly (e.g. the one of a fleet target) wins.
+    def repository_registry(self, repo):
+        if self.registry != DEFAULT_ECR_REGISTRY:
+            return self.registry
+        repositories = self.ecr.describe_repositories([repo]).get('repositories', [])
+        if not repositories:
+            raise EcrError('RepositoryNotFoundException', 'repository ' + repo + ' not found')
+        return repositories[0]['repositoryUri'].split('/', 1)[0]
+
+    # Mount blobs of a repository into another one of the same registry with the registry API v2 (a mount moves
+    # no data). A 202 answer means the registry can't mount the blob and has opened an upload instead.
+    def mount_blobs(self, source_repo, repo, digests):
+        import base64
+        import http.client
+        from urllib.parse import urlencode, urlsplit
+        password, expires_at = self.get_authorization()
+        registry = self.repository_registry(repo)
+        url = urlsplit(registry if '://' in registry else 'https://' + registry)
+        connection_class = http.client.HTTPConnection if url.scheme == 'http' else http.client.HTTPSConnection
+        conn = connection_class(url.hostname, url.port, timeout=60)
+        headers = {'Authorization': 'Basic ' + base64.b64encode(('AWS:' + password).encode()).decode(),
+                   'Content-Length': '0'}
+        try:
+            for digest in digests:
+                conn.request('POST', '/v2/' + repo + '/blobs/uploads/?' +
+                             urlencode({'mount': digest, 'from': source_repo}), headers=headers)
+                rsp = conn.getresponse()
+                rsp.read()
+                if rsp.status != 201:
+                    raise EcrError('BlobMountFailed', digest + ': HTTP ' + str(rsp.status))
+        except (http.client.HTTPException, OSError) as e:
+            raise EcrError('ConnectionError', str(e))
+        finally:
+            conn.close()
+
+    # Put the manifest of an image of source_repo (a BatchGetImage item) into repo. When ECR answers that the
+    # layers aren't in repo yet, they are mounted from source_repo and the manifest is put again.
+    def put_manifest(self, source_repo, repo, image, tag=None):
+        args = (repo, image['imageManifest'], tag, image.get('imageManifestMediaType'), image['imageId']['imageDigest'])
+        try:
+            self.ecr.put_image(*args)
+        except EcrError as e:
+            if e.code == 'ImageAlreadyExistsException':
+                return
+            if e.code != 'LayersNotFoundException':
+                raise
+            manifest = json.loads(image['imageManifest'])
+            blobs = [layer['digest'] for layer in manifest.get('layers', [])]
+            if 'config' in manifest:
+                blobs.insert(0, manifest['config']['digest'])
+            self.mount_blobs(source_repo, repo, blobs)
+            self.ecr.put_image(*args)
+
+    # Copy a tag of source_repo into repo on the registry side: only the manifest moves. The manifests referenced
+    # by a manifest list (multi-arch images) are put first, by digest.
+    def promote_image(self, source_repo, repo, tag, image):
+        for child in json.loads(image['imageManifest']).get('manifests', []):
+            response = self.ecr.batch_get_image(source_repo, [{'imageDigest': child['digest']}],
+                                                ECR_MANIFEST_MEDIA_TYPES)
+            if not response.get('images'):
+                raise EcrError('ImageNotFound', 'manifest ' + child['digest'] + ' not found in ' + source_repo)
+            self.put_manifest(source_repo, repo, response['images'][0])
+        try:
+            self.put_manifest(source_repo, repo, image, tag)
+        except EcrError as e:
+            # an IMMUTABLE tag that already exists is checked by the verification
+            if e.code != 'ImageTagAlreadyExistsException':
+                raise
+
+    # Read the digests of tags of a repository with BatchGetImage: returns {tag: BatchGetImage item}
+    def get_tagged_images(self, repo, tags, media_types=None):
+        images = {}
+        for i in range(0, len(tags), ECR_BATCH_GET_MAX):
+            response = self.ecr.batch_get_image(repo, [{'imageTag': tag} for tag in tags[i:i + ECR_BATCH_GET_MAX]],
+                                                media_types)
+            for image in response.get('images', []):
+                images[image['imageId'].get('imageTag')] = image
+        return images
+
+    # Promote tags from the '-snapshot' repository to the release one without pulling anything locally: the
+    # manifests are copied with PutImage (the layers are mounted only when the release repository lacks them), the
+    # tags are promoted concurrently and the release digests are verified against the snapshot ones at the end
+    def promote(self):
+        from concurrent.futures import ThreadPoolExecutor
+        repo = usr_inp('Enter the repository name: ')
+        tags = [tag.strip() for tag in usr_inp('Insert the tags to promote (comma separated): ').split(',')
+                if tag.strip()]
+        if repo == '' or not tags:
+            print('ABORT: Repository name or tags are empty...')
+            sys.exit(1)
+        source_repo = repo + '-snapshot'
+
+        try:
+            images = self.get_tagged_images(source_repo, tags, ECR_MANIFEST_MEDIA_TYPES)
+            present = self.get_tagged_images(repo, tags)
+        except EcrError as e:
+            print('ERROR: Error while reading the images to promote!')
+            self.print_ecr_error(e)
+            return -1
+
+        def promote(tag):
+            if tag not in images:
+                return tag, 'ERROR: not found in ' + source_repo
+            if tag in present and present[tag]['imageId']['imageDigest'] == images[tag]['imageId']['imageDigest']:
+                return tag, 'already present'
+            try:
+                self.promote_image(source_repo, repo, tag, images[tag])
+                return tag, 'promoted'
+            except EcrError as e:
+                return tag, 'ERROR: ' + str(e)
+
+        print('INFO: Promoting ' + str(len(tags)) + ' tags from ' + source_repo + ' to ' + repo)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            outcomes = dict(executor.map(promote, tags))
+
+        # the release tags must now have the snapshot digests
+        try:
+            promoted = self.get_tagged_images(repo, tags)
+        except EcrError as e:
+            print('ERROR: Error while verifying the promoted images!')
+            self.print_ecr_error(e)
+            return -1
+        failed = 0
+        for tag in tags:
+            outcome = outcomes[tag]
+            if not outcome.startswith('ERROR'):
+                expected = images[tag]['imageId']['imageDigest']
+                actual = promoted.get(tag, {}).get('imageId', {}).get('imageDigest')
+                if actual != expected:
+                    outcome = ('ERROR: digest mismatch, ' + repo + ':' + tag + ' is ' + str(actual) + ' instead of ' +
+                               expected)
+            failed += outcome.startswith('ERROR')
+            print('%-2s %-40s %s' % ('KO' if outcome.startswith('ERROR') else 'OK', tag, outcome))
+        print('INFO: %d of %d tags promoted and verified' % (len(tags) - failed, len(tags)))
+        return -1 if failed else 0
+
+    # Get the registry password and its expiration (epoch seconds) from an ECR authorization token, whose
+    # 'authorizationToken' is the base64 of 'AWS:<password>'
+    def get_authorization(self, label=None):
+        import base64
+        data = self.ecr.get_authorization_token(label=label)['authorizationData'][0]
+        password = base64.b64decode(data['authorizationToken']).decode().split(':', 1)[1]
+        expires_at = parse_aws_timestamp(data.get('expiresAt')) or time.time() + 12 * 3600
+        return password, expires_at
 
     def is_installed(self):
         from shutil import which
@@ -476,7 +3163,7 @@ class Aws:
 
     def logout(self):
         containerruntime = self.container_runtime
-        cmd = [containerruntime, 'logout', '350801433917.dkr.ecr.eu-west-1.amazonaws.com']
+        cmd = [containerruntime, 'logout', self.registry]
         print('\n::: AWS LOGOUT: ' + ' '.join(cmd) + ' ::: \n')
         result = runcmd_call(cmd)
         print(result.decode())
@@ -489,17 +3176,29 @@ class Aws:
             region = props['region']
             profile = self.aws_prof_name
             containerruntime = self.container_runtime
-            cmd = ['aws', 'ecr', 'get-login-password', '--region', region, '--profile', profile]
-            print('\n::: GET-LOGIN: ' + ' '.join(cmd) + ' ::: \n')
-
-            token = runcmd_call(cmd)
+            registry = self.registry
+
+            # a cached token is used until it gets close to its expiration, and if the runtime is already
+            # logged in with it there is nothing left to do
+            token_cache = EcrTokenCache()
+            entry = token_cache.get(profile, region, registry)
+            if entry is None:
+                print('\n::: GET-LOGIN: region ' + region + ', profile ' + profile + ' ::: \n')
+                password, expires_at = self.get_authorization(label='GET-LOGIN')
+                entry = token_cache.put(profile, region, registry, password, expires_at)
+            elif runtime_has_credential(containerruntime, registry, 'AWS', entry['password']):
+                print('SUCCESS: Already logged in, the token is valid until ' +
+                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['expiresAt'])))
+                return 0
+            else:
+                print('INFO: Using the cached token, valid until ' +
+                      time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['expiresAt'])))
 
             # Execute the Docker Login by security token
-            cmd = [containerruntime, 'login', '-u', 'AWS', '--password-stdin',
-                   '350801433917.dkr.ecr.eu-west-1.amazonaws.com']
+            cmd = [containerruntime, 'login', '-u', 'AWS', '--password-stdin', registry]
             print('\n::: ' + containerruntime.upper() + ': ' + ' '.join(cmd) + ' ::: \n')
 
-            returncode = runcmd_sh(cmd, token)
+            returncode = runcmd_sh(cmd, entry['password'].encode())
 
             # When using podman there is no daemon, it depends on the VM being started, although NOT definitive 125 return code
             #  often coincides that the user has not started the machine with 'podman machine start', so give a hint.
@@ -517,6 +3216,52 @@ class Aws:
             print('ERROR: The login procedure is failed. Check the credentials and retry!::')
             sys.exit(1)
 
+    # Delete the given digests (any iterable, also a lazy one) from a repository by grouping them into
+    # BatchDeleteImage calls of at most ECR_BATCH_DELETE_MAX image ids each. For every call it yields the batch,
+    # the deleted digests and the per-image failures as (digest, failure code, failure reason): a partial failure
+    # is reported digest by digest without aborting the remaining batches.
+    def iter_batch_delete(self, repo, digests, verbose=True):
+        from itertools import islice
+        digests = iter(digests)
+
+        while True:
+            batch = list(islice(digests, ECR_BATCH_DELETE_MAX))
+            if not batch:
+                return
+            try:
+                response = self.ecr.batch_delete_image(repo, [{'imageDigest': digest} for digest in batch],
+                                                       label='PURGE' if verbose else None)
+            except EcrError as e:
+                # the whole call failed: every digest of the batch is still there
+                yield batch, [], [(digest, str(e.code), e.message) for digest in batch]
+                continue
+
+            deleted = list(dict.fromkeys(image['imageDigest'] for image in response.get('imageIds', [])
+                                         if 'imageDigest' in image))
+            failures = [(failure.get('imageId', {}).get('imageDigest', ''), failure.get('failureCode', ''),
+                         failure.get('failureReason', '')) for failure in response.get('failures', [])]
+            yield batch, deleted, failures
+
+    # Run iter_batch_delete to the end. Returns the deleted digests, the failures and the elapsed seconds.
+    def batch_delete_digests(self, repo, digests, verbose=True):
+        deleted, failures = [], []
+        start = time.time()
+        for batch, batch_deleted, batch_failures in self.iter_batch_delete(repo, digests, verbose):
+            deleted += batch_deleted
+            failures += batch_failures
+        return deleted, failures, time.time() - start
+
+    # Print the outcome of batch_delete_digests: one line per failed digest plus the deletion throughput
+    def print_batch_delete_report(self, requested, deleted, failures, elapsed):
+        for digest, code, reason in failures:
+            print('ERROR: ' + digest + ' not deleted: ' + code + ' - ' + reason)
+        if failures:
+            print('Checkout the documentation for AWS cli 2: '
+                  'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
+        rate = len(deleted) / elapsed if elapsed > 0 else 0.0
+        print('INFO: Deleted %d of %d digests in %.1fs (%.1f digests/sec)' % (len(deleted), requested, elapsed, rate))
+        print()
+
     def purge_images(self):
 
         rsp = usr_inp('Do you want to delete UNTAGGED images or a specific one?[untagged|single] ') or 'untagged'
@@ -527,46 +3272,40 @@ class Aws:
             if rsp == 'yes':
                 repo = usr_inp('Enter the repository name: ')
                 profile = self.aws_prof_name
-                if repo != '' and profile != '':
-                    cmd = ['aws', 'ecr', 'list-images', '--repository-name', repo, '--profile', profile, '--filter',
-                           'tagStatus=UNTAGGED', '--query', 'imageIds[*]', '--output', 'text']
+                if repo == '' or profile == '':
+                    print('ABORT: Repository name is empty...')
+                    sys.exit(1)
                 print('INFO: Removing the untagged images on AWS ECR repository')
             else:
                 print('ABORT: User denied...')
                 sys.exit(1)
 
-            debug_msg = '::: LIST-IMAGES: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            untagged_images = runcmd_checkoutput(cmd)
-            if type(untagged_images) == int:
+            inventory = EcrInventory.open_existing(self.inventory_scope())
+            digests = None
+            if self.from_inventory and inventory is not None:
+                error = self.inventory_age_error(repo, inventory.repositories().get(repo, (None, None))[1])
+                if error is not None:
+                    print('ERROR: ' + error)
+                    return -1
+                digests = [row[1] for row in inventory.untagged_images(repo)]
+                print('INFO: ' + str(len(digests)) + ' untagged images found in the inventory')
+            summary = self.purge_repository(repo, verbose=True, digests=digests, recheck=digests is not None)
+            if inventory is not None:
+                inventory.remove_digests(repo, summary['deleted'])
+            if summary['retagged']:
+                print('WARN: ' + str(summary['retagged']) + ' images of the inventory are tagged or deleted now: '
+                      'not purged')
+            if summary['error'] is not None:
                 print('ERROR: Error during the purge: check the repository information!')
-                print('Code: ' + str(untagged_images))
-                print('''
-                    Checkout the documentation for AWS cli: '
-                      'https://docs.aws.amazon.com/cli/latest/topic/return-codes.html
-                      ''')
-                return -1
-            else:
-                untagged_images = untagged_images.decode()
-                untagged_images = untagged_images.rstrip().split('\n')
-
-            if len(untagged_images) > 0 and untagged_images[0] != '':
-                for image in untagged_images:
-                    cmd = ['aws', 'ecr', 'batch-delete-image', '--profile', profile, '--repository-name', repo,
-                           '--image-ids', 'imageDigest=' + image]
-                    debug_msg = '::: PURGE: ' + ' '.join(cmd) + ' ::: \n'
-                    print(debug_msg)
-                    res = runcmd_checkoutput(cmd)
-                    if type(res) == int:
-                        print('ERROR: Error during the purge!')
-                        print('Error code: ' + str(res))
-                        print('Checkout the documentation for AWS cli 2: '
-                              'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                        break
-                    else:
-                        continue
+                self.print_ecr_error(summary['error'])
+                if summary['count'] == 0:
+                    return -1
+
+            if summary['count'] > 0:
+                self.print_batch_delete_report(summary['count'], summary['deleted'], summary['failures'],
+                                               summary['elapsed'])
                 print("COMPLETED!")
-            else:
+            elif summary['error'] is None:
                 print('INFO: Congrats. There are no untagged images in the specified repository!')
             return 0
 
@@ -578,18 +3317,15 @@ class Aws:
                 tag = usr_inp('Insert the desidered tag: ') or ''
                 profile = self.aws_prof_name
                 if tag != '' and profile != '':
-                    cmd = ['aws', 'ecr', 'batch-delete-image', '--profile', profile, '--repository-name', repo,
-                           '--image-ids', 'imageTag=' + tag]
-                    debug_msg = '::: PURGE: ' + ' '.join(cmd) + ' ::: \n'
-                    print(debug_msg)
-                    res = runcmd_checkoutput(cmd)
-                    if type(res) == int:
-                        print('ERROR: Error during the purge!')
-                        print('Error code: ' + str(res))
-                        print('Checkout the documentation for AWS cli 2: '
-                              'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                    else:
+                    try:
+                        res = self.ecr.batch_delete_image(repo, [{'imageTag': tag}], label='PURGE')
+                        if res.get('failures'):
+                            failure = res['failures'][0]
+                            raise EcrError(failure.get('failureCode', ''), failure.get('failureReason', ''))
                         print('INFO: Congrats. Specified image has been deleted!')
+                    except EcrError as e:
+                        print('ERROR: Error during the purge!')
+                        self.print_ecr_error(e)
             else:
                 print('ABORT: User denied...')
                 sys.exit(1)
@@ -601,90 +3337,286 @@ class Aws:
         # To delete all untagged images
         rsp = usr_inp('Are you sure to delete all untagged images on any AWS ECR repository?[yes|NO] ') or 'no'
         if rsp == 'yes':
-            cmd = ['aws', 'ecr', 'describe-repositories']
             print('INFO: Retrieving all repos...')
         else:
             print('ABORT: User denied...')
             sys.exit(1)
 
-        debug_msg = '::: LIST-REPOS: ' + ' '.join(cmd) + ' ::: \n'
-
-        print(debug_msg)
+        profile = self.aws_prof_name
+        totals = {'repos': 0, 'count': 0, 'deleted': 0, 'incomplete': 0}
+        start = time.time()
 
-        response = runcmd_checkoutput(cmd)
+        # the backend is created once here and then shared by all the workers
+        self.ecr
 
-        if type(response) == int:
-            print('ERROR: Error during execution!')
-            print('Code: ' + str(response))
-            print('''
-                Checkout the documentation for AWS cli: '
-                  'https://docs.aws.amazon.com/cli/latest/topic/return-codes.html
-                  ''')
+        inventory = EcrInventory.open_existing(self.inventory_scope())
+        if self.from_inventory and inventory is None:
+            print('ERROR: The inventory is empty. Run \'--aws inventory-refresh\' first.')
             return -1
+
+        journal = PurgeJournal(self.inventory_scope())
+        if journal.start(self.resume):
+            print('INFO: Resuming the run ' + journal.run + ': ' + str(len(journal.completed)) +
+                  ' repositories already purged, ' + str(len(journal.deleted)) + ' digests already deleted')
+        elif self.resume:
+            print('INFO: No interrupted run to resume, starting a new one')
+
+        def print_summary(summary):
+            self.print_repo_purge_summary(summary)
+            if inventory is not None:
+                inventory.remove_digests(summary['repo'], summary['deleted'])
+            totals['repos'] += 1
+            totals['count'] += summary['count']
+            totals['deleted'] += len(summary['deleted'])
+            if summary['error'] is not None or summary['failures']:
+                totals['incomplete'] += 1
+
+        # The repositories are submitted to the pool as soon as their page of describe-repositories arrives.
+        # Summaries are printed in submission order, so every repository is printed as a single block, and at
+        # most a few repositories per worker are in flight, so memory doesn't grow with the registry size.
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if self.from_inventory:
+                # the untagged digests come from the inventory: no listing, but they are checked again on ECR
+                # before being deleted, and only in repositories refreshed recently
+                untagged = {}
+                refreshed = inventory.repositories()
+                for repo, digest, size, pushed_at in inventory.untagged_images():
+                    if "snapshot" not in repo.lower():
+                        continue
+                    if repo not in journal.completed and digest not in journal.deleted:
+                        untagged.setdefault(repo, []).append(digest)
+                for repo, digests in untagged.items():
+                    error = self.inventory_age_error(repo, refreshed.get(repo, (None, None))[1])
+                    if error is not None:
+                        print('ERROR: ' + error)
+                        totals['incomplete'] += 1
+                        continue
+                    pending.append(executor.submit(self.purge_repository, repo, profile, False, digests, journal,
+                                                   True))
+            try:
+                for repo in [] if self.from_inventory else self.iter_repositories(label='LIST-REPOS'):
+                    # Filter for snapshot ones (release ones can't contain untagged images)
+                    if "snapshot" not in repo['repositoryName'].lower():
+                        continue
+                    # the repositories completed by the interrupted run are not listed again
+                    if repo['repositoryName'] in journal.completed:
+                        continue
+                    pending.append(executor.submit(self.purge_repository, repo['repositoryName'], profile, False,
+                                                   None, journal))
+                    while pending and (pending[0].done() or len(pending) > 2 * self.workers):
+                        print_summary(pending.popleft().result())
+            except EcrError as e:
+                print('ERROR: Error during execution!')
+                self.print_ecr_error(e)
+                totals['incomplete'] += 1
+                if not pending and totals['repos'] == 0:
+                    journal.close()
+                    return -1
+            while pending:
+                print_summary(pending.popleft().result())
+
+        # a run with errors is left open, so that '--resume' retries only what is still missing
+        if totals['incomplete']:
+            journal.close()
+            print('INFO: The purge is not complete: run it again with --resume to retry only what is missing')
         else:
-            response = response.decode()
+            journal.finish()
+        elapsed = time.time() - start
+        print("Purge completed! You successfully deleted", totals['count'], "images in your ECR registry.")
+        if elapsed > 0:
+            print('INFO: %d repositories purged by %d workers: %d digests in %.1fs (%.1f digests/sec)'
+                  % (totals['repos'], self.workers, totals['deleted'], elapsed, totals['deleted'] / elapsed))
+        # an incomplete run fails, so that the callers know it has to be resumed
+        return -1 if totals['incomplete'] else 0
+
+    # Select the stale images of a snapshot repository: the images whose last pull (or push, when never pulled)
+    # is older than stale_days, except the keep_last most recently pushed ones and the ones with a tag matching
+    # protect (the compiled protect_tags). Returns (repo, [(digest, size, tags, last activity)]) or (repo, EcrError).
+    def plan_stale_images(self, repo, protect=None):
+        images = ImageInventory()
+        try:
+            images.add_details(self.iter_image_details(repo), repo)
+        except EcrError as e:
+            return repo, e
+
+        stale_before = time.time() - self.stale_days * 86400
+        candidates = [row for row in images.sorted_by_age(newest_first=True)[self.keep_last:]
+                      if max(images.pushed_at[row], images.pulled_at[row]) < stale_before]
+        if protect is not None:
+            candidates = images.difference(candidates, images.with_tags_matching(protect))
+        return repo, [(images.digest(row), images.sizes[row], images.tags(row),
+                       max(images.pushed_at[row], images.pulled_at[row])) for row in candidates]
+
+    # Delete the tagged and untagged snapshot images not pulled in the last stale_days. The plan (images and
+    # bytes per repository) is always printed first: with dry_run nothing is deleted, otherwise the stale
+    # digests are deleted through the batched delete after a confirmation.
+    def prune_stale(self):
+        import re
+        from concurrent.futures import ThreadPoolExecutor
+        # the expression is checked before any work: an invalid one would fail in every worker
+        try:
+            protect = re.compile(self.protect_tags) if self.protect_tags else None
+        except re.error as e:
+            print('ERROR: Invalid --protect-tags regular expression: ' + str(e))
+            return -1
 
-        to_dict = json.loads(response)
-        repositories = to_dict['repositories']
-        list_repo_names = []
+        try:
+            repos = [repo['repositoryName'] for repo in self.iter_repositories(label='LIST-REPOS')
+                     if 'snapshot' in repo['repositoryName'].lower()]
+        except EcrError as e:
+            print('ERROR: Error while retrieving the repositories!')
+            self.print_ecr_error(e)
+            return -1
 
-        # List all ECR repos
-        for repo in repositories:
-            # Filter for snapshot ones (release ones can't contain untagged images)
-            if "snapshot" in repo['repositoryName'].lower():
-                list_repo_names.append(repo['repositoryName'])
+        print('INFO: Planning: images not pulled in %d days, keeping the last %d of every repository%s'
+              % (self.stale_days, self.keep_last,
+                 ' and the tags matching ' + self.protect_tags if self.protect_tags else ''))
+        plan = []
+        errors = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for repo, stale in executor.map(lambda repo: self.plan_stale_images(repo, protect), repos):
+                if isinstance(stale, EcrError):
+                    errors += 1
+                    print('ERROR: ' + repo + ': ' + str(stale))
+                elif stale:
+                    plan.append((repo, stale))
+                    print('%-60s %6d images %12s' % (repo, len(stale), format_bytes(sum(i[1] for i in stale))))
+
+        count = sum(len(stale) for repo, stale in plan)
+        size = sum(image[1] for repo, stale in plan for image in stale)
+        print('INFO: %d stale images in %d repositories, %s' % (count, len(plan), format_bytes(size)))
+        if self.dry_run or count == 0:
+            return -1 if errors else 0
+        rsp = usr_inp('Do you want to delete ' + str(count) + ' stale images?[yes|NO] ') or 'no'
+        if rsp != 'yes':
+            print('ABORT: User denied...')
+            sys.exit(1)
 
-        profile = self.aws_prof_name
+        def prune(entry):
+            repo, stale = entry
+            return self.purge_repository(repo, digests=[image[0] for image in stale])
+
+        deleted = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for summary in executor.map(prune, plan):
+                self.print_repo_purge_summary(summary, 'Stale')
+                deleted += len(summary['deleted'])
+                if summary['error'] is not None or summary['failures']:
+                    errors += 1
+        print('INFO: Prune completed: %d of %d stale images deleted' % (deleted, count))
+        # the repositories that couldn't be planned or purged make the prune fail
+        return -1 if errors else 0
+
+    # Print the runs recorded in the purge journal, the latest last (only the last limit ones, when given), with
+    # the deleted and failed digests of every repository
+    def purge_audit(self, limit=0):
+        journal = PurgeJournal(self.inventory_scope())
+        runs = journal.runs()
+        if not runs:
+            print('INFO: The purge journal is empty')
+            return 0
+        for run in runs[-limit:] if limit > 0 else runs:
+            deleted = sum(len(info['deleted']) for info in run['repos'].values())
+            failed = sum(len(info['failed']) for info in run['repos'].values())
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started'])) if run['started'] else '?'
+            print('RUN ' + run['run'] + ' started ' + started + ' - ' + ('completed' if run['ended'] else 'interrupted')
+                  + ': ' + str(len(run['repos'])) + ' repositories, ' + str(deleted) + ' digests deleted, '
+                  + str(failed) + ' failed')
+            for repo, info in sorted(run['repos'].items()):
+                print('    %-60s %6d deleted %6d failed%s' % (repo, len(info['deleted']), len(info['failed']),
+                                                          '' if info['done'] else ' (incomplete)'))
+        print('INFO: Deleted digests are recorded in ' + journal.path)
+        return 0
+
+    # List and delete the untagged images of a single repository (or the given digests, when they come from the
+    # inventory: with recheck only the ones still untagged on ECR are deleted). Nothing is printed unless verbose,
+    # so that it can run in a worker thread. Every batch is recorded in the journal, if any. Returns a summary
+    # consumed by print_repo_purge_summary.
+    def purge_repository(self, repo, profile=None, verbose=False, digests=None, journal=None, recheck=False):
+        summary = {'repo': repo, 'count': 0, 'deleted': [], 'failures': [], 'elapsed': 0.0, 'error': None,
+                   'retagged': 0}
+        start = time.time()
 
-        total_count = 0
-        # Retrieve all untagged images for each repo
-        for repo in list_repo_names:
-            print("###################### REPO:", repo)
+        try:
+            # the listing of the repository is completed before deleting from it: deleting the images of a
+            # listing that is still being paginated may shift its continuation token and skip some of them
+            if digests is None:
+                digests = [image['imageDigest'] for image in
+                           self.iter_image_ids(repo, 'UNTAGGED', label='LIST-IMAGES' if verbose else None)]
+            elif recheck:
+                untagged = self.still_untagged(repo, digests)
+                summary['retagged'] = len(digests) - len(untagged)
+                digests = untagged
+            for batch, deleted, failures in self.iter_batch_delete(repo, digests, verbose):
+                summary['count'] += len(batch)
+                summary['deleted'] += deleted
+                summary['failures'] += failures
+                if journal is not None:
+                    journal.record_batch(repo, deleted, failures)
+            if journal is not None and not summary['failures']:
+                journal.record_repo(repo, summary['count'])
+        except EcrError as e:
+            summary['error'] = e
+
+        summary['elapsed'] = time.time() - start
+        return summary
+
+    # Describe again on ECR digests of a repository taken from the inventory, ECR_DESCRIBE_IMAGES_MAX at a time,
+    # and return the ones that still exist and have no tags: an image tagged after the last refresh of the
+    # inventory must not be purged
+    def still_untagged(self, repo, digests):
+        untagged = []
+        for i in range(0, len(digests), ECR_DESCRIBE_IMAGES_MAX):
+            image_ids = [{'imageDigest': digest} for digest in digests[i:i + ECR_DESCRIBE_IMAGES_MAX]]
+            try:
+                details = self.ecr.describe_images(repo, image_ids).get('imageDetails', [])
+            except EcrError as e:
+                if e.code != 'ImageNotFoundException':
+                    raise
+                # an image has been deleted in the meantime: describe the others one by one
+                details = []
+                for image_id in image_ids:
+                    try:
+                        details += self.ecr.describe_images(repo, [image_id]).get('imageDetails', [])
+                    except EcrError as e:
+                        if e.code != 'ImageNotFoundException':
+                            raise
+            untagged += [detail['imageDigest'] for detail in details if not detail.get('imageTags')]
+        return untagged
+
+    # Error message when the inventory of a repository is too old to purge from (refreshed more than
+    # inventory_ttl seconds ago, INVENTORY_PURGE_MAX_AGE when it is 0, or never), None otherwise
+    def inventory_age_error(self, repo, refreshed_at):
+        max_age = self.inventory_ttl or INVENTORY_PURGE_MAX_AGE
+        if refreshed_at is not None and refreshed_at >= time.time() - max_age:
+            return None
+        return (repo + ': not refreshed in the inventory in the last ' + str(max_age) + ' seconds, run '
+                '\'--aws inventory-refresh\' first (or raise --inventory-ttl)')
+
+    def print_repo_purge_summary(self, summary, kind='Untagged'):
+        print("###################### REPO:", summary['repo'])
+        print()
+        if summary.get('retagged'):
+            print('WARN: ' + str(summary['retagged']) + ' images of the inventory are tagged or deleted now: '
+                  'not purged')
+            print()
+        if summary['error'] is not None:
+            print('ERROR: Error during the purge: check the repository information or permissions!')
+            self.print_ecr_error(summary['error'])
+            print()
+        elif summary['count'] > 0:
+            print("######### " + kind + " images count: ", summary['count'])
+            print()
+            if summary['failures']:
+                print('ERROR: Error during this purge! Keep note of the repository and verify later.')
+            self.print_batch_delete_report(summary['count'], summary['deleted'], summary['failures'],
+                                           summary['elapsed'])
+        else:
+            print('INFO: Congrats. There are no untagged images in the specified repository!')
             print()
-            cmd = ['aws', 'ecr', 'list-images', '--repository-name', repo, '--profile', profile, '--filter',
-                   'tagStatus=UNTAGGED', '--query', 'imageIds[*]', '--output', 'text']
-
-            debug_msg = '::: LIST-IMAGES: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            untagged_images = runcmd_checkoutput(cmd)
-            if type(untagged_images) == int:
-                print('ERROR: Error during the purge: check the repository information or permissions!')
-                print('Code: ' + str(untagged_images))
-                print('''
-                                Checkout the documentation for AWS cli: '
-                                  'https://docs.aws.amazon.com/cli/latest/topic/return-codes.html
-                                  ''')
-                continue
-                # return -1
-            else:
-                untagged_images = untagged_images.decode()
-                untagged_images = untagged_images.rstrip().split('\n')
-
-            if len(untagged_images) > 0 and untagged_images[0] != '':
-                print("######### Untagged images count: ", len(untagged_images))
-                print()
-                total_count += len(untagged_images)
-                # with open("logs/purge.log", "w+") as file:
-                for image in untagged_images:
-                    cmd = ['aws', 'ecr', 'batch-delete-image', '--profile', profile, '--repository-name', repo,
-                           '--image-ids', 'imageDigest=' + image]
-                    debug_msg = '::: PURGE: ' + ' '.join(cmd) + ' ::: \n'
-                    print(debug_msg)
-                    # file.write(debug_msg)
-                    res = runcmd_checkoutput(cmd)
-                    if type(res) == int:
-                        print('ERROR: Error during this purge! Keep note of the repository and verify later.')
-                        print('Error code: ' + str(res))
-                        print('Checkout the documentation for AWS cli 2: '
-                              'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                        # break
-                        # else:
-                        continue
-            else:
-                print('INFO: Congrats. There are no untagged images in the specified repository!')
-                print()
-                # file.close()
-        print("Purge completed! You successfully deleted", total_count, "images in your ECR registry.")
 
     def set_profile(self):
         rsp = usr_inp('Are you sure to configure a profile?[yes|NO]') or 'no'
@@ -708,25 +3640,12 @@ class Aws:
                 print('ERROR: One or more params are empty. Cannot complete the configuration of the profile!')
                 sys.exit(1)
             else:
-                cmd = ['aws', 'configure', 'set', 'aws_access_key_id', access_key_id, '--profile', profile_name]
-
-                print('\n::: ' + ' '.join(cmd) + ' ::: \n')
-                print(runcmd_call(cmd))
-
-                cmd = ['aws', 'configure', 'set', 'aws_secret_access_key', access_secret_key, '--profile', profile_name]
-
-                print('\n::: ' + ' '.join(cmd) + ' ::: \n')
-                print(runcmd_call(cmd))
-
-                cmd = ['aws', 'configure', 'set', 'region', region, '--profile', profile_name]
-
-                print('\n::: ' + ' '.join(cmd) + ' ::: \n')
-                print(runcmd_call(cmd))
-
-                cmd = ['aws', 'configure', 'set', 'output', output, '--profile', profile_name]
-
-                print('\n::: ' + ' '.join(cmd) + ' ::: \n')
-                print(runcmd_call(cmd))
+                print('\n::: SET-PROFILE: ' + profile_name + ' in ' + ' and '.join(aws_files_paths()) + ' ::: \n')
+                try:
+                    store_aws_profile(profile_name, access_key_id, access_secret_key, region, output)
+                except OSError as e:
+                    print('ERROR: Cannot write the AWS configuration files: ' + str(e))
+                    sys.exit(1)
 
                 print('INFO: Profile configured successfully!')
                 sys.exit(0)
@@ -735,31 +3654,20 @@ class Aws:
             sys.exit(1)
 
     def get_profile_info(self):
-        try:
-            profile_name = usr_inp('Insert the profile\'s name you would like to use: ')
-            cmd = ['aws', 'configure', 'get', 'aws_access_key_id', '--profile', profile_name]
-            access_key = (runcmd_checkoutput(cmd))
-            if type(access_key) == int:
-                print("ERROR: The specified AWS profile is not configured. Use '--aws set-profile' to set a new one.")
-                sys.exit(0)
-
-            cmd = ['aws', 'configure', 'get', 'aws_secret_access_key', '--profile', profile_name]
-            secret_key = (runcmd_call(cmd).decode())
-
-            cmd = ['aws', 'configure', 'get', 'region', '--profile', profile_name]
-            region = (runcmd_call(cmd).decode())
-
-            cmd = ['aws', 'configure', 'get', 'output', '--profile', profile_name]
-            output = (runcmd_call(cmd).decode())
-            self.aws_prof_name = profile_name
-            self.aws_props_lists = [('aws_access_key_id', access_key.decode().strip()), \
-                                    ('aws_secret_access_key', secret_key.strip()), \
-                                    ('region', region.strip()), \
-                                    ('output', output.strip())]
-            print(self.aws_props_lists)
-        except:
+        profile_name = usr_inp('Insert the profile\'s name you would like to use: ')
+        settings = resolve_aws_profile(profile_name) if profile_name != '' else None
+        if settings is None:
             print("ERROR: The specified AWS profile is not configured. Use '--aws set-profile' to set a new one.")
-            sys.exit(0)
+            sys.exit(1)
+
+        self.aws_prof_name = profile_name
+        self.aws_props_lists = [('aws_access_key_id', settings.get('aws_access_key_id', '')), \
+                                ('aws_secret_access_key', settings.get('aws_secret_access_key', '')), \
+                                ('region', settings.get('region', '')), \
+                                ('output', settings.get('output', ''))]
+        print(self.aws_props_lists)
+        if settings.get('aws_session_token'):
+            self.aws_props_lists.append(('aws_session_token', settings['aws_session_token']))
 
     def get_current_profile(self):
         cmd = ['aws', 'configure', 'list']
@@ -769,7 +3677,7 @@ class Aws:
     def get_version(self):
         cmd = ['aws', '--version']
 
-        res = runcmd_checkoutput(cmd).decode()
+        res = runcmd_version(cmd).decode()
         index_vers = res.strip().index('Python')
 
         substr = res[:index_vers]
@@ -783,21 +3691,26 @@ class Aws:
         repo = usr_inp('Enter the repository name: ')
         profile = self.aws_prof_name
         if repo != '' and profile != '':
-            cmd = ['aws', 'ecr', 'list-images', '--repository-name', repo, '--profile', profile, '--output', 'json']
-
-            debug_msg = '::: LIST-IMAGES: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            res = runcmd_checkoutput(cmd)
-            if type(res) == int:
-                print('ERROR: Error while retrieving the images!')
-                print('Error code: ' + str(res))
-                print('Checkout the documentation for AWS cli 2: '
-                      'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                sys.exit(0)
+            # the output is written page by page, as soon as every page arrives. The image ids come from
+            # list-images, any other field needs the image details of describe-images. With --format the
+            # request isn't printed, so that the output can be piped.
+            label = None if self.output_format else 'LIST-IMAGES'
+            if self.fields is None or set(self.fields) <= {'imageDigest', 'imageTag'}:
+                writer = RecordWriter(self.output_format or 'json', self.fields, 'imageIds',
+                                      columns=['imageDigest', 'imageTag'])
+                images = self.iter_image_ids(repo, label=label)
             else:
-                images = res.decode()
-                print(images)
-                sys.exit(0)
+                writer = RecordWriter(self.output_format or 'json', self.fields, 'imageDetails')
+                images = self.iter_image_details(repo, label=label)
+            try:
+                for image in images:
+                    writer.write(image)
+            except EcrError as e:
+                print('ERROR: Error while retrieving the images!')
+                self.print_ecr_error(e)
+                sys.exit(1)
+            writer.close()
+            sys.exit(0)
 
     def create_repo(self):
         print("This command will allow you to create a repo on ECR for both release and snapshot images.")
@@ -809,44 +3722,86 @@ class Aws:
         repo = usr_inp('Enter the repository name: ')
         profile = self.aws_prof_name
         if repo != '' and profile != '':
+            failed = False
             # release repo
-            cmd = ['aws', 'ecr', 'create-repository', '--repository-name', repo, '--image-tag-mutability', 'IMMUTABLE',
-                   '--image-scanning-configuration', 'scanOnPush=true']
-
-            debug_msg = '::: CREATE-REPO FOR RELEASE: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            res = runcmd_checkoutput(cmd)
-            if type(res) == int:
+            try:
+                res = self.ecr.create_repository(repo, 'IMMUTABLE', True, label='CREATE-REPO FOR RELEASE')
+                print(json.dumps(res, indent=4))
+            except EcrError as e:
                 print('ERROR: Error while creating the repos!')
-                print('Error code: ' + str(res))
-                print('Checkout the documentation for AWS cli 2: '
-                      'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                # sys.exit(0)
-            else:
-                images = res.decode()
-                print(images)
-                # sys.exit(0)
-
-            cmd = ['aws', 'ecr', 'create-repository', '--repository-name', repo + '-snapshot', '--image-tag-mutability',
-                   'MUTABLE',
-                   '--image-scanning-configuration', 'scanOnPush=true']
-
-            # snapshot repo
-            debug_msg = '::: CREATE-REPO FOR SNAPSHOT: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            res = runcmd_checkoutput(cmd)
-            if type(res) == int:
+                self.print_ecr_error(e)
+                failed = True
+
+            # snapshot repo, cleaned up by ECR through its lifecycle policy
+            try:
+                res = self.ecr.create_repository(repo + '-snapshot', 'MUTABLE', True, label='CREATE-REPO FOR SNAPSHOT')
+                print(json.dumps(res, indent=4))
+                self.ecr.put_lifecycle_policy(repo + '-snapshot', self.snapshot_lifecycle_policy(),
+                                              label='LIFECYCLE-POLICY FOR SNAPSHOT')
+            except EcrError as e:
                 print('ERROR: Error while creating the repos!')
-                print('Error code: ' + str(res))
-                print('Checkout the documentation for AWS cli 2: '
-                      'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                sys.exit(0)
-            else:
-                images = res.decode()
-                print(images)
-                sys.exit(0)
+                self.print_ecr_error(e)
+                failed = True
+            sys.exit(1 if failed else 0)
         pass
 
+    # Create (action 'create') or delete (action 'delete') the repositories of a manifest. The manifest is diffed
+    # against a single listing of the registry, so only the missing repositories are created and only the
+    # existing ones are deleted: running it again when nothing has changed costs just the listing.
+    def sync_repositories(self, manifest, action):
+        from concurrent.futures import ThreadPoolExecutor
+        try:
+            repositories = load_repository_manifest(manifest)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print('ERROR: Invalid manifest ' + manifest + ': ' + str(e))
+            return -1
+
+        try:
+            existing = set(repo['repositoryName'] for repo in self.iter_repositories(label='LIST-REPOS'))
+        except EcrError as e:
+            print('ERROR: Error while retrieving the repositories!')
+            self.print_ecr_error(e)
+            return -1
+
+        if action == 'create':
+            todo = [name for name in repositories if name not in existing]
+        else:
+            todo = [name for name in repositories if name in existing]
+        print('INFO: ' + str(len(repositories)) + ' repositories in the manifest, ' + str(len(todo)) + ' to ' + action)
+        if not todo:
+            return 0
+        if action == 'delete':
+            for name in todo:
+                print('    ' + name)
+            rsp = usr_inp('Do you want to delete ' + str(len(todo)) + ' repositories?[yes|NO] ') or 'no'
+            if rsp != 'yes':
+                print('ABORT: User denied...')
+                sys.exit(1)
+
+        def apply(name):
+            spec = repositories[name]
+            try:
+                if action == 'create':
+                    self.ecr.create_repository(name, spec['mutability'], spec['scanOnPush'])
+                    if spec['lifecycle']:
+                        self.ecr.put_lifecycle_policy(name, self.snapshot_lifecycle_policy())
+                else:
+                    self.ecr.delete_repository(name)
+                return name, None
+            except EcrError as e:
+                return name, e
+
+        failed = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for name, error in executor.map(apply, todo):
+                if error is None:
+                    print('INFO: ' + name + (' created' if action == 'create' else ' deleted'))
+                else:
+                    failed += 1
+                    print('ERROR: ' + name + ' not ' + action + 'd: ' + str(error))
+        print('INFO: %d repositories %sd, %d failed' % (len(todo) - failed, action, failed))
+        return -1 if failed else 0
+
     def delete_repo(self):
         repo = usr_inp('Enter the repository name: ')
 
@@ -854,54 +3809,284 @@ class Aws:
         profile = self.aws_prof_name
         print(profile)
         if repo != '' and profile != '':
-            cmd = ['aws', 'ecr', 'delete-repository', '--repository-name', repo, '--profile', profile, '--output',
-                   'json']
-
-            debug_msg = '::: REMOVE-REPO for RELEASE: ' + ' '.join(cmd) + ' ::: \n'
-            print(debug_msg)
-            res = runcmd_call(cmd)
-            if type(res[1]) == int:
-                message = res[0].decode("utf-8")
+            try:
+                res = self.ecr.delete_repository(repo, label='REMOVE-REPO for RELEASE')
+                print(json.dumps(res, indent=4))
+            except EcrError as e:
                 print('ERROR: Error while removing the repository!')
-                print('Error code: ' + str(res[1]))
-                print('Error message:' + message)
-                print('Checkout the documentation for AWS cli 2: '
-                      'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
+                self.print_ecr_error(e)
                 sys.exit(0)
-            else:
-                images = res.decode()
-                print(images)
-                # sys.exit(0)
 
             if snapshot.lower() == 'y':
-                cmd = ['aws', 'ecr', 'delete-repository', '--repository-name', repo + '-snapshot', '--profile', profile,
-                       '--output',
-                       'json']
-
-                debug_msg = '::: REMOVE-REPO for SNAPSHOT: ' + ' '.join(cmd) + ' ::: \n'
-                print(debug_msg)
-                res = runcmd_call(cmd)
-                if type(str(res[1])) == int:
-                    message = res[0].decode("utf-8")
+                try:
+                    res = self.ecr.delete_repository(repo + '-snapshot', label='REMOVE-REPO for SNAPSHOT')
+                    print(json.dumps(res, indent=4))
+                except EcrError as e:
                     print('ERROR: Error while removing the repository!')
-                    print('Error code: ' + str(res[1]))
-                    print('Error message:' + message)
-                    print('Checkout the documentation for AWS cli 2: '
-                          'https://awscli.amazonaws.com/v2/documentation/api/latest/topic/return-codes.html')
-                    sys.exit(0)
-                else:
-                    images = res.decode()
-                    print(images)
-                    sys.exit(0)
+                    self.print_ecr_error(e)
+                sys.exit(0)
 
 
 ### END of the AWS class
 
+### DOCKER CREDENTIAL HELPER
+# START
+
+# Name of the helper: the runtimes run it as 'docker-credential-<name>'
+CREDENTIAL_HELPER_NAME = 'ea-ecr'
+
+
+# Implement the docker credential helper protocol (get, store, erase, list) on top of the ECR token cache.
+# 'get' receives the registry on stdin and answers with the cached token: on a cache hit it runs neither a
+# subprocess nor a network call. On a miss the token is fetched with the profile in AWS_PROFILE (or 'default').
+def credential_helper(action, stdin=sys.stdin, stdout=sys.stdout):
+    import re
+    token_cache = EcrTokenCache()
+
+    if action == 'list':
+        json.dump({registry: 'AWS' for registry in token_cache.registries()}, stdout)
+        return 0
+
+    server_url = stdin.read().strip()
+    registry = re.sub('^https?://', '', server_url).rstrip('/').split('/')[0]
+    ecr_host = re.match(ECR_REGISTRY_PATTERN, registry)
+
+    if action == 'store':
+        # the credentials always come from ECR: the ones stored by a login are ignored
+        return 0
+    if action == 'erase':
+        token_cache.remove(registry)
+        return 0
+    if action != 'get':
+        stdout.write('unknown credential helper action: ' + action + '\n')
+        return 1
+
+    entry = token_cache.find(registry)
+    if entry is None and ecr_host is not None:
+        import os
+        profile = os.environ.get('AWS_PROFILE') or 'default'
+        settings = resolve_aws_profile(profile) or {}
+        region = ecr_host.group(1)
+        props = [(name, settings.get(name, '')) for name in ('aws_access_key_id', 'aws_secret_access_key',
+                                                               'aws_session_token')] + [('region', region)]
+        try:
+            endpoint_url = os.environ.get('AWS_ENDPOINT_URL_ECR') or os.environ.get('AWS_ENDPOINT_URL')
+            aws = Aws(aws_props_lists=props, aws_prof_name=profile, endpoint_url=endpoint_url)
+            password, expires_at = aws.get_authorization()
+        except (EcrError, KeyError, ValueError):
+            stdout.write('credentials not found in native keychain\n')
+            return 1
+        entry = token_cache.put(profile, region, registry, password, expires_at)
+    if entry is None:
+        stdout.write('credentials not found in native keychain\n')
+        return 1
+
+    json.dump({'ServerURL': server_url, 'Username': 'AWS', 'Secret': entry['password']}, stdout)
+    return 0
+
+
+# Configure the container runtime to use this script as credential helper for the given registry: a
+# 'docker-credential-ea-ecr' launcher is written in ~/.local/bin and the registry is added to the 'credHelpers'
+# of the runtime auth file
+def install_credential_helper(container_runtime, registry):
+    import os
+    import tempfile
+    bin_dir = os.path.join(os.path.expanduser('~'), '.local', 'bin')
+    launcher = os.path.join(bin_dir, 'docker-credential-' + CREDENTIAL_HELPER_NAME)
+    os.makedirs(bin_dir, exist_ok=True)
+    with open(launcher, 'w') as launcher_file:
+        launcher_file.write('#!/bin/sh\nexec "' + sys.executable + '" "' + os.path.abspath(__file__) +
+                            '" --credential-helper "$@"\n')
+    os.chmod(launcher, 0o755)
+
+    auth_path = runtime_auth_file(container_runtime)
+    if auth_path is None:
+        home = os.path.expanduser('~')
+        auth_path = os.path.join(home, '.config', 'containers', 'auth.json') if container_runtime == 'podman' \
+            else os.path.join(os.environ.get('DOCKER_CONFIG') or os.path.join(home, '.docker'), 'config.json')
+        os.makedirs(os.path.dirname(auth_path), mode=0o700, exist_ok=True)
+    try:
+        with open(auth_path) as auth_file:
+            config = json.load(auth_file)
+    except FileNotFoundError:
+        config = {}
+    except (OSError, ValueError) as e:
+        # the file holds the credentials of the other registries: it is never replaced when it can't be read
+        print('ERROR: Cannot read ' + auth_path + ': ' + str(e))
+        return -1
+    config.setdefault('credHelpers', {})[registry] = CREDENTIAL_HELPER_NAME
+    # a previous 'login' would take precedence over the helper
+    config.get('auths', {}).pop(registry, None)
+
+    # the file is replaced through a temporary one (created with mode 0600), so that a crash or a concurrent
+    # login never leaves it truncated
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(auth_path), prefix='.' + os.path.basename(auth_path))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(config, tmp_file, indent=4)
+        os.replace(tmp_path, auth_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    print('INFO: Credential helper written in ' + launcher)
+    print('INFO: ' + auth_path + ' now uses it for ' + registry)
+    if bin_dir not in os.environ.get('PATH', '').split(os.pathsep):
+        print('WARN: ' + bin_dir + ' is not in your PATH: add it, otherwise ' + container_runtime +
+              ' won\'t find the helper.')
+    return 0
+
+
+# END
+
+### PUSH CHECK
+# START
+
+# Check which ECR images of a bulk push are already in their repositories, so that their push can be skipped.
+# The local repository digests of the images are read concurrently, then each repository is checked with one
+# batch of ECR calls, with the profile in AWS_PROFILE (or 'default') and the region of the registry. Returns
+# {image: (ok, message)} for the images that must not be pushed; an image that can't be checked is pushed.
+def ecr_push_check(container_runtime, images, workers=DEFAULT_WORKERS, endpoint_url=None):
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+
+    refs = [(image, parse_ecr_image(image)) for image in images]
+    refs = [(image, ref) for image, ref in refs if ref is not None]
+    if not refs:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        local = dict(zip([image for image, ref in refs],
+                         executor.map(container_runtime.local_repo_digests, [image for image, ref in refs])))
+
+    groups = {}
+    for image, (registry, region, repo, tag) in refs:
+        groups.setdefault((region, repo), {})[tag] = (image, local[image])
+
+    profile = os.environ.get('AWS_PROFILE') or 'default'
+    settings = resolve_aws_profile(profile) or {}
+    endpoint_url = endpoint_url or os.environ.get('AWS_ENDPOINT_URL_ECR') or os.environ.get('AWS_ENDPOINT_URL')
+    clients = {}
+    skip = {}
+    for (region, repo), tags in groups.items():
+        if region not in clients:
+            props = [(name, settings.get(name, '')) for name in ('aws_access_key_id', 'aws_secret_access_key',
+                                                                   'aws_session_token')] + [('region', region)]
+            clients[region] = Aws(aws_props_lists=props, aws_prof_name=profile, endpoint_url=endpoint_url,
+                                  workers=workers)
+        try:
+            results = clients[region].check_pushes(repo, {tag: digests for tag, (image, digests) in tags.items()})
+        except (EcrError, KeyError, IndexError) as e:
+            print('INFO: ' + repo + ' not checked, its images are pushed: ' + str(e))
+            continue
+        for tag, result in results.items():
+            skip[tags[tag][0]] = result
+    return skip
+
+# END
+
+### FLEET MODE
+# START
+
+# Commands that can run on many targets, with the prompts answered once and forwarded to every target
+FLEET_COMMANDS = {
+    'login': [],
+    'list-images': ['Enter the repository name: '],
+    'create-repo': ['Enter the repository name: '],
+    'purge-images-all': ['Are you sure to delete all untagged images on any AWS ECR repository?[yes|NO] '],
+}
+
+
+# Parse the --targets option into a list of {'profile', 'region', 'registry'} (region and registry may be None).
+# The option is either a comma separated list of PROFILE[:REGION[:REGISTRY]] or @FILE, with one target per line
+# and '#' comments.
+def parse_targets(spec):
+    if spec.startswith('@'):
+        with open(spec[1:]) as targets_file:
+            entries = [line.split('#', 1)[0].strip() for line in targets_file]
+    else:
+        entries = [entry.strip() for entry in spec.split(',')]
+
+    targets = []
+    for entry in entries:
+        if entry == '':
+            continue
+        parts = entry.split(':', 2) + [None, None]
+        targets.append({'profile': parts[0], 'region': parts[1] or None, 'registry': parts[2] or None})
+    return targets
+
+
+# Run an --aws command on every target, each one in a child process of this script with the profile, region and
+# registry of the target: the answers to the prompts of the command are asked once and forwarded to all of them.
+# The outputs are printed target by target, in order, followed by a report with the outcome of each target: a
+# target is OK when its process exits with 0, the ERROR and ABORT lines of its output are only counted.
+def run_fleet(command, targets, workers=DEFAULT_WORKERS, prompts=None):
+    import os
+    import re
+    from concurrent.futures import ThreadPoolExecutor
+
+    if command == 'login' and any(target['registry'] is None for target in targets):
+        print('ERROR: The login needs the registry of every target (PROFILE:REGION:REGISTRY)')
+        return 1
+    answers = [usr_inp(prompt) for prompt in (FLEET_COMMANDS[command] if prompts is None else prompts)]
+
+    # the arguments of this invocation, without --targets
+    argv = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip or arg.startswith('--targets='):
+            skip = False
+            continue
+        if arg == '--targets':
+            skip = True
+            continue
+        argv.append(arg)
+
+    def run(target):
+        cmd = [sys.executable, os.path.abspath(__file__)] + argv
+        if target['registry']:
+            cmd += ['--registry', target['registry']]
+        env = dict(os.environ)
+        if target['region']:
+            env['AWS_REGION'] = env['AWS_DEFAULT_REGION'] = target['region']
+        start = time.time()
+        p = subprocess.run(cmd, input='\n'.join([target['profile']] + answers) + '\n', env=env,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        return target, p.returncode, p.stdout, time.time() - start
+
+    # the logins run one at a time: the runtimes rewrite their auth file without locking it
+    if command == 'login':
+        workers = 1
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(targets)))) as executor:
+        for target, returncode, output, elapsed in executor.map(run, targets):
+            name = target['profile'] + ':' + (target['region'] or '-') + ':' + (target['registry'] or '-')
+            print('###################### TARGET: ' + name)
+            print(output)
+            errors = len(re.findall(r'\b(?:ERROR|ABORT):', output))
+            results.append((name, 'OK' if returncode == 0 else 'KO', errors, elapsed))
+
+    print('###################### FLEET REPORT: ' + command)
+    for name, status, errors, elapsed in results:
+        print('%-100s %s %4d errors %7.1fs' % (name, status, errors, elapsed))
+    failed = sum(1 for result in results if result[1] != 'OK')
+    print('INFO: %d of %d targets completed successfully' % (len(results) - failed, len(results)))
+    return 1 if failed else 0
+
+# END
+
 # Factory to redirect commands to proper functions
 def main():
+    # The credential helper is served before anything else, to keep its startup as short as possible
+    if len(sys.argv) == 3 and sys.argv[1] == '--credential-helper':
+        sys.exit(credential_helper(sys.argv[2]))
+
     # Get the command line options
     args = parse_args()
 
+    global VERSION_CACHE_ENABLED
+    VERSION_CACHE_ENABLED = not args.no_cache
+
     printflush('DEBUG: the arguments values are: ' + str(args) + '\n')
 
     # Manages the --aws arguments
@@ -912,11 +4097,16 @@ def main():
             else:
                 runtime = args.containerruntime
 
-            aws = Aws(container_runtime=runtime)
-            if aws.is_installed():
+            aws = Aws(container_runtime=runtime, workers=args.workers, ecr_backend=args.ecr_backend,
+                      endpoint_url=args.endpoint_url, from_inventory=args.from_inventory,
+                      untagged_days=args.untagged_days, keep_tagged=args.keep_tagged, resume=args.resume,
+                      registry=args.registry, output_format=args.output_format, fields=args.fields,
+                      stale_days=args.stale_days, keep_last=args.keep_last, protect_tags=args.protect_tags,
+                      dry_run=args.dry_run, inventory_ttl=args.inventory_ttl)
+            if not aws.needs_cli(args.aws[0]) or aws.is_installed():
 
                 # check which version is installed
-                if 1.0 <= aws.get_version() <= 2.0:
+                if aws.needs_cli(args.aws[0]) and 1.0 <= aws.get_version() <= 2.0:
                     print('''
                         -------------------------------------------------------------------------------
                         Note: AWS CLI version 2, the latest major version of the AWS CLI, is now stable and recommended 
@@ -925,19 +4115,42 @@ def main():
                         -------------------------------------------------------------------------------
                         ''')
 
+                # fleet mode: the command runs once per target, each one in its own process
+                if args.targets and args.aws[0] in FLEET_COMMANDS:
+                    # a manifest replaces the prompts of create-repo
+                    sys.exit(run_fleet(args.aws[0], parse_targets(args.targets), args.workers,
+                                       [] if args.manifest else None))
+
                 # check if input needs profile's info
                 if args.aws[0] in ['login', 'purge-images', 'purge-images-all', 'list-images', 'create-repo',
-                                   'delete-repo']:
+                                   'delete-repo', 'inventory-refresh', 'inventory-query', 'lifecycle-diff',
+                                   'lifecycle-apply', 'purge-audit', 'storage-report', 'prune-stale', 'scan-report',
+                                   'duplicates', 'promote']:
                     aws.get_profile_info()
 
+                returncode = 0
                 if args.aws[0] == 'login':
-                    aws.login()
+                    returncode = aws.login()
                 elif args.aws[0] == 'logout':
-                    aws.logout()
+                    returncode = aws.logout()
+                elif args.aws[0] == 'credential-helper':
+                    returncode = install_credential_helper(runtime, args.registry)
                 elif args.aws[0] == 'purge-images':
-                    aws.purge_images()
+                    returncode = aws.purge_images()
                 elif args.aws[0] == 'purge-images-all':
-                    aws.purge_images_all()
+                    returncode = aws.purge_images_all()
+                elif args.aws[0] == 'purge-audit':
+                    returncode = aws.purge_audit(args.limit)
+                elif args.aws[0] == 'storage-report':
+                    returncode = aws.storage_report(args.limit)
+                elif args.aws[0] == 'prune-stale':
+                    returncode = aws.prune_stale()
+                elif args.aws[0] == 'scan-report':
+                    returncode = aws.scan_report(args.limit)
+                elif args.aws[0] == 'duplicates':
+                    returncode = aws.duplicates_report(args.limit)
+                elif args.aws[0] == 'promote':
+                    returncode = aws.promote()
                 elif args.aws[0] == 'set-profile':
                     aws.set_profile()
                 elif args.aws[0] == 'get-profile':
@@ -948,10 +4161,25 @@ def main():
                     print(aws.get_version())
                 elif args.aws[0] == 'list-images':
                     print(aws.list_images())
+                elif args.aws[0] in ('create-repo', 'delete-repo') and args.manifest:
+                    returncode = aws.sync_repositories(args.manifest, args.aws[0].replace('-repo', ''))
                 elif args.aws[0] == 'create-repo':
                     print(aws.create_repo())
                 elif args.aws[0] == 'delete-repo':
                     print(aws.delete_repo())
+                elif args.aws[0] == 'inventory-refresh':
+                    returncode = aws.inventory_refresh(args.inventory_ttl)
+                elif args.aws[0] == 'inventory-query':
+                    returncode = aws.inventory_query(args.query, args.limit)
+                elif args.aws[0].startswith('lifecycle-'):
+                    returncode = aws.lifecycle(args.aws[0].replace('lifecycle-', ''))
+
+                if args.ecr_stats and aws._ecr is not None:
+                    aws.ecr.limiter.print_stats()
+
+                # the commands return 0 on success and a negative value (or the return code of the cli) on failure
+                if isinstance(returncode, int) and returncode != 0:
+                    sys.exit(1)
 
 
             else:
@@ -965,8 +4193,33 @@ def main():
                 -------------------------------------------------------------------------------
                 ''')
 
+        elif args.bulk:
+            runtime = args.containerruntime[0] if type(args.containerruntime) == list else args.containerruntime
+            container_runtime = create_container_runtime(runtime, args.runtime_api, args.runtime_socket,
+                                                         args.transfer_stats, args.prometheus_textfile,
+                                                         args.force_push)
+            if not container_runtime.is_installed():
+                print('ERROR: ' + runtime + ' is not installed in the current system.')
+                sys.exit(1)
+            try:
+                images = load_image_list(args.images, args.manifest)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print('ERROR: Invalid list of images: ' + str(e))
+                sys.exit(1)
+            if not images:
+                print('ERROR: No images: use --images or --manifest')
+                sys.exit(1)
+            # the images already in ECR are not pushed again
+            skip = {}
+            if args.bulk == 'push' and not container_runtime.force_push:
+                skip = ecr_push_check(container_runtime, images, args.workers, args.endpoint_url)
+            results = container_runtime.bulk(args.bulk, images, args.workers, skip)
+            if any(not result['ok'] for result in results):
+                sys.exit(1)
+
         elif args.docker:
-            docker = Docker()
+            docker = create_container_runtime('docker', args.runtime_api, args.runtime_socket, args.transfer_stats,
+                                              args.prometheus_textfile, args.force_push)
             if docker.is_installed():
 
                 if args.docker[0] == 'version':
@@ -992,7 +4245,8 @@ def main():
                 ''')
 
         elif args.podman:
-            podman = Podman()
+            podman = create_container_runtime('podman', args.runtime_api, args.runtime_socket, args.transfer_stats,
+                                              args.prometheus_textfile, args.force_push)
             if podman.is_installed():
 
                 if args.podman[0] == 'version':
@@ -1148,7 +4402,7 @@ def main():
                 Result: KO
                 Details: OpenShift Cluster is not installed. To download it, check the link: https://www.okd.io/download.html
                 ''')
-                elif float(oc.get_version()) < 3.9 or docker.get_version() != 1.13:
+                elif parse_major_minor(oc.get_version()) < (3, 9) or docker.get_version() != 1.13:
                     passed = False
                     print('''\
                 --------------------------------------------------------------------------------- 
@@ -1260,8 +4514,11 @@ def main():
                       'https://github.com/openshift/source-to-image#for-linux
                     ''')
 
-    except:
-        pass
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except Exception as e:
+        print('ABORT: ' + str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
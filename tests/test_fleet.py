@@ -0,0 +1,84 @@
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+INIT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'init.py')
+
+
+def load_init():
+    spec = importlib.util.spec_from_file_location('init', INIT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Fake ECR API: ListImages succeeds in eu-west-1 and fails with RepositoryNotFoundException in any other region
+# (the region comes from the credential scope of the signature)
+class FakeEcrHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if '/eu-west-1/ecr/' in self.headers.get('Authorization', ''):
+            code, body = 200, {'imageIds': [{'imageDigest': 'sha256:' + '0' * 64, 'imageTag': 'v1'}]}
+        else:
+            code, body = 400, {'__type': 'RepositoryNotFoundException', 'message': 'The repository does not exist'}
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FleetReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeEcrHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        os.makedirs(os.path.join(home.name, '.aws'))
+        with open(os.path.join(home.name, '.aws', 'credentials'), 'w') as credentials:
+            credentials.write('[p]\naws_access_key_id = AK\naws_secret_access_key = SK\n')
+        with open(os.path.join(home.name, '.aws', 'config'), 'w') as config:
+            config.write('[profile p]\nregion = eu-west-1\n')
+        environ = mock.patch.dict(os.environ, {'HOME': home.name})
+        environ.start()
+        self.addCleanup(environ.stop)
+        for name in ('AWS_REGION', 'AWS_DEFAULT_REGION', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ.pop(name, None)
+
+        self.init = load_init()
+
+    def test_failing_target_is_reported_ko(self):
+        argv = ['init.py', '--aws', 'list-images', '--ecr-backend', 'http', '--endpoint-url',
+                'http://127.0.0.1:%d' % self.server.server_port, '--targets', 'p:eu-west-1,p:eu-central-1']
+        targets = self.init.parse_targets('p:eu-west-1,p:eu-central-1')
+        output = io.StringIO()
+        with mock.patch.object(sys, 'argv', argv), mock.patch.object(self.init, 'usr_inp', return_value='app'), \
+                contextlib.redirect_stdout(output):
+            returncode = self.init.run_fleet('list-images', targets, workers=2)
+
+        report = output.getvalue().split('FLEET REPORT: list-images')[1].splitlines()
+        statuses = {line.split()[0]: line.split()[1] for line in report if line.startswith('p:')}
+        self.assertEqual(statuses, {'p:eu-west-1:-': 'OK', 'p:eu-central-1:-': 'KO'})
+        self.assertEqual(returncode, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()